@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+#
+# A stand-in gnhastd for benchmarking collectors without a real server.
+# Speaks enough of the gnhastd line protocol for the py-gnhast client:
+# answers ldevs with a reg per device, honours feed/cfeed/ask, and then
+# replays synthetic updates (and alarms, for alarm listeners) at a fixed rate.
+#
+
+import argparse
+import asyncio
+import os
+import random
+import shlex
+import tempfile
+import time
+
+
+class FakeDevice(object):
+    """ One synthetic device in the population """
+    __slots__ = ('uid', 'name', 'devt', 'subt', 'proto', 'arg', 'lo', 'hi')
+
+    def __init__(self, uid, name, devt, subt, proto, arg, lo=0.0, hi=100.0):
+        self.uid = uid
+        self.name = name
+        self.devt = devt
+        self.subt = subt
+        self.proto = proto
+        self.arg = arg
+        self.lo = lo
+        self.hi = hi
+
+    def reg_line(self):
+        return 'reg uid:{0} name:"{1}" rrdname:{2} devt:{3} subt:{4} proto:{5}\n'.format(
+            self.uid, self.name, self.uid[:20], self.devt, self.subt,
+            self.proto)
+
+    def upd_line(self):
+        value = random.uniform(self.lo, self.hi)
+        return 'upd uid:{0} {1}:{2:.4f}\n'.format(self.uid, self.arg, value)
+
+
+def make_population(gn_conn, count, prefix='bench'):
+    """ Build count sensors, cycling through temp/humid/pressure/number.
+        The type and subtype tables come from a py-gnhast connection so the
+        numbers always match what the client library expects.
+    """
+    kinds = [('temp', -10.0, 40.0), ('humid', 0.0, 100.0),
+             ('pressure', 950.0, 1050.0), ('number', 0.0, 100000.0)]
+    sensor = gn_conn.cf_type.index('sensor')
+    devices = []
+    for i in range(count):
+        kind, lo, hi = kinds[i % len(kinds)]
+        subt = gn_conn.cf_subt.index(kind)
+        devices.append(FakeDevice('{0}{1:05d}'.format(prefix, i),
+                                  'Bench {0} {1}'.format(kind, i),
+                                  sensor, subt, 0,
+                                  gn_conn.arg_by_subt[subt], lo, hi))
+    return devices
+
+
+def parse_args(words):
+    """ Turn ['uid:foo', 'rate:5'] into a dict """
+    args = {}
+    for word in words:
+        if ':' in word:
+            key, val = word.split(':', 1)
+            args[key] = val
+    return args
+
+
+class FakeClient(object):
+    """ Per-connection state """
+    def __init__(self, writer):
+        self.writer = writer
+        self.name = None
+        self.fed = []
+        self.fed_set = set()
+        self.alarms = False
+        self.regs = 0
+        self.upds = 0
+        self.task = None
+
+
+class FakeGnhastd(object):
+    """ The server.  devices is a list of FakeDevice, updates is the total
+        number of upd (and setalarm) lines to send each client, rate is
+        lines per second, 0 for as fast as the socket will take them.
+    """
+    def __init__(self, devices=None, updates=1000, rate=0, tick=0.01,
+                 host='127.0.0.1', port=0):
+        self.devices = devices or []
+        self.updates = updates
+        self.rate = rate
+        self.tick = tick
+        self.host = host
+        self.port = port
+        self.server = None
+        self.clients = []
+        self.sent = 0
+        self.first_sent = None
+        self.last_sent = None
+
+    def set_population(self, devices):
+        self.devices = devices
+
+    def find(self, uid):
+        for dev in self.devices:
+            if dev.uid == uid:
+                return dev
+        return None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_client,
+                                                 self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def stop(self):
+        for client in self.clients:
+            if client.task is not None:
+                client.task.cancel()
+            client.writer.close()
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def handle_client(self, reader, writer):
+        client = FakeClient(writer)
+        self.clients.append(client)
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                words = shlex.split(line.decode('utf-8', 'replace'))
+            except ValueError:
+                continue
+            if not words:
+                continue
+            await self.handle_command(client, words[0], parse_args(words[1:]))
+        if client.task is not None:
+            client.task.cancel()
+        writer.close()
+
+    async def handle_command(self, client, cmd, args):
+        writer = client.writer
+        if cmd == 'client':
+            client.name = args.get('client')
+        elif cmd == 'ldevs':
+            if 'uid' in args:
+                devs = [d for d in self.devices if d.uid == args['uid']]
+            else:
+                devs = self.devices
+            writer.write(''.join(d.reg_line() for d in devs).encode())
+            writer.write(b'endldevs\n')
+            await writer.drain()
+        elif cmd in ('feed', 'cfeed'):
+            dev = self.find(args.get('uid'))
+            if dev is not None and dev.uid not in client.fed_set:
+                client.fed_set.add(dev.uid)
+                client.fed.append(dev)
+                self.start_replay(client)
+        elif cmd in ('ask', 'askf'):
+            dev = self.find(args.get('uid'))
+            if dev is not None:
+                writer.write(dev.upd_line().encode())
+                await writer.drain()
+        elif cmd == 'reg':
+            client.regs += 1
+        elif cmd == 'upd':
+            client.upds += 1
+        elif cmd == 'listenalarms':
+            client.alarms = True
+            self.start_replay(client)
+        elif cmd == 'disconnect':
+            writer.close()
+
+    def start_replay(self, client):
+        if client.task is None:
+            client.task = asyncio.ensure_future(self.replay(client))
+
+    def next_line(self, client, i):
+        if client.alarms and (not client.fed or i % 2):
+            sev = (i * 7) % 100
+            return 'setalarm aluid:benchalarm{0} altext:"Bench alarm {0}" alsev:{1} alchan:1\n'.format(
+                i % 50, sev)
+        return client.fed[i % len(client.fed)].upd_line()
+
+    async def replay(self, client):
+        """ Push updates to a client until we've sent self.updates of them.
+            Lines are written a tick's worth at a time, so high rates don't
+            cost a syscall per line.
+        """
+        loop = asyncio.get_event_loop()
+        # give the client a moment to finish asking for feeds
+        await asyncio.sleep(0.1)
+        i = 0
+        start = loop.time()
+        self.first_sent = time.perf_counter()
+        while i < self.updates:
+            if self.rate > 0:
+                due = min(self.updates, int((loop.time() - start) * self.rate) + 1)
+            else:
+                due = min(self.updates, i + 1000)
+            if due > i:
+                chunk = ''.join(self.next_line(client, n) for n in range(i, due))
+                client.writer.write(chunk.encode())
+                await client.writer.drain()
+                self.sent += due - i
+                i = due
+            if self.rate > 0:
+                await asyncio.sleep(self.tick)
+        self.last_sent = time.perf_counter()
+
+
+def parse_cmdline():
+    parser = argparse.ArgumentParser(description='Fake gnhastd for benchmarks')
+
+    parser.add_argument('--host', type=str, action='store',
+                        default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, action='store',
+                        default=2920, help='Port to listen on')
+    parser.add_argument('--devices', type=int, action='store',
+                        default=500, help='Number of synthetic devices')
+    parser.add_argument('--updates', type=int, action='store',
+                        default=100000, help='Updates to send each client')
+    parser.add_argument('--rate', type=int, action='store',
+                        default=1000, help='Updates per second, 0 for max')
+
+    args = parser.parse_args()
+    return args
+
+
+async def main(loop):
+    from gnhast import gnhast
+
+    args = parse_cmdline()
+    server = FakeGnhastd(updates=args.updates, rate=args.rate,
+                         host=args.host, port=args.port)
+    port = await server.start()
+
+    # borrow the type tables from py-gnhast, it needs a conf to start
+    conf = tempfile.NamedTemporaryFile('w', suffix='.conf', delete=False)
+    print('gnhastd {', file=conf)
+    print('  hostname = "{0}"'.format(args.host), file=conf)
+    print('  port = {0}'.format(port), file=conf)
+    print('}', file=conf)
+    conf.close()
+    gn_conn = gnhast.gnhast(loop, conf.name)
+    os.unlink(conf.name)
+    server.set_population(make_population(gn_conn, args.devices))
+
+    print('Fake gnhastd on {0}:{1} with {2} devices, {3} updates at {4}/sec'.format(
+        args.host, port, args.devices, args.updates, args.rate))
+
+
+if __name__ == "__main__":
+    loop = asyncio.get_event_loop()
+    loop.create_task(main(loop))
+    try:
+        loop.run_forever()
+    finally:
+        loop.close()
+    exit(0)
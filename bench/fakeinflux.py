@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+#
+# A stand-in InfluxDB 1.x HTTP endpoint for benchmarks.  Handles /ping,
+# /query (SHOW DATABASES, CREATE DATABASE, anything else answers empty) and
+# /write, counting requests, bytes and points.  Latency, 5xx errors and
+# outages can be injected to exercise batching, retry and spooling.
+#
+
+import argparse
+import asyncio
+import json
+import random
+import urllib.parse
+
+
+STATUS_TEXT = {200: 'OK', 204: 'No Content', 400: 'Bad Request',
+               404: 'Not Found', 500: 'Internal Server Error',
+               503: 'Service Unavailable'}
+
+
+class FakeInflux(object):
+    """ The server.  latency is seconds added to every request, error_rate
+        is the fraction of writes answered with a 500.  Set down to True to
+        answer everything with a 503 until it's set back.
+    """
+    def __init__(self, databases=None, latency=0.0, error_rate=0.0,
+                 keep=False, host='127.0.0.1', port=0):
+        self.databases = set(databases or [])
+        self.latency = latency
+        self.error_rate = error_rate
+        self.keep = keep
+        self.down = False
+        self.host = host
+        self.port = port
+        self.server = None
+        self.lines = []
+        self.requests = 0
+        self.writes = 0
+        self.errors = 0
+        self.bytes = 0
+        self.points = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_client,
+                                                 self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    def outage(self, seconds):
+        """ Go down now, come back after seconds """
+        self.down = True
+        asyncio.get_event_loop().call_later(seconds, self.come_up)
+
+    def come_up(self):
+        self.down = False
+
+    def stats(self):
+        return {'requests': self.requests, 'writes': self.writes,
+                'errors': self.errors, 'bytes': self.bytes,
+                'points': self.points}
+
+    async def read_body(self, reader, headers):
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            body = b''
+            while True:
+                size = int((await reader.readline()).strip() or b'0', 16)
+                if size == 0:
+                    await reader.readline()
+                    return body
+                body += await reader.readexactly(size)
+                await reader.readline()
+        length = int(headers.get('content-length', 0))
+        if length:
+            return await reader.readexactly(length)
+        return b''
+
+    async def handle_client(self, reader, writer):
+        try:
+            while True:
+                request = await reader.readline()
+                if not request:
+                    break
+                try:
+                    method, target, version = request.decode('latin-1').split()
+                except ValueError:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    key, _, val = line.decode('latin-1').partition(':')
+                    headers[key.strip().lower()] = val.strip()
+                body = await self.read_body(reader, headers)
+
+                status, payload = await self.dispatch(method, target, body)
+                self.send(writer, status, payload)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        writer.close()
+
+    def send(self, writer, status, payload):
+        head = 'HTTP/1.1 {0} {1}\r\n'.format(status, STATUS_TEXT.get(status, ''))
+        head += 'X-Influxdb-Version: 1.8.0-fake\r\n'
+        if payload is None:
+            head += 'Content-Length: 0\r\n\r\n'
+            writer.write(head.encode('latin-1'))
+            return
+        data = json.dumps(payload).encode('utf-8')
+        head += 'Content-Type: application/json\r\n'
+        head += 'Content-Length: {0}\r\n\r\n'.format(len(data))
+        writer.write(head.encode('latin-1') + data)
+
+    async def dispatch(self, method, target, body):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        url = urllib.parse.urlsplit(target)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        if url.path == '/ping':
+            return 204, None
+        if self.down:
+            self.errors += 1
+            return 503, {'error': 'fake influx is down'}
+        if url.path == '/query':
+            if 'q' not in params and body:
+                params.update(urllib.parse.parse_qsl(body.decode('utf-8')))
+            return 200, self.query(params.get('q', ''))
+        if url.path == '/write':
+            return self.write(params, body)
+        return 404, {'error': 'not found'}
+
+    def query(self, q):
+        words = q.strip().rstrip(';').split()
+        upper = [w.upper() for w in words]
+        if upper[:2] == ['SHOW', 'DATABASES']:
+            series = [{'name': 'databases', 'columns': ['name'],
+                       'values': [[db] for db in sorted(self.databases)]}]
+            return {'results': [{'statement_id': 0, 'series': series}]}
+        if upper[:2] == ['CREATE', 'DATABASE'] and len(words) > 2:
+            self.databases.add(words[2].strip('"'))
+        return {'results': [{'statement_id': 0}]}
+
+    def write(self, params, body):
+        self.writes += 1
+        if params.get('db') not in self.databases:
+            self.errors += 1
+            return 404, {'error': 'database not found: "{0}"'.format(params.get('db'))}
+        if self.error_rate and random.random() < self.error_rate:
+            self.errors += 1
+            return 500, {'error': 'injected failure'}
+        self.bytes += len(body)
+        lines = [l for l in body.split(b'\n') if l.strip()]
+        self.points += len(lines)
+        if self.keep:
+            self.lines.extend(lines)
+        return 204, None
+
+
+def parse_cmdline():
+    parser = argparse.ArgumentParser(description='Fake InfluxDB for benchmarks')
+
+    parser.add_argument('--host', type=str, action='store',
+                        default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, action='store',
+                        default=8086, help='Port to listen on')
+    parser.add_argument('--db', type=str, action='store',
+                        default='gnhast', help='Database that exists')
+    parser.add_argument('--latency', type=float, action='store',
+                        default=0.0, help='Seconds added to every request')
+    parser.add_argument('--error_rate', type=float, action='store',
+                        default=0.0, help='Fraction of writes that get a 500')
+    parser.add_argument('--report', type=int, action='store',
+                        default=10, help='Print stats every N seconds')
+
+    args = parser.parse_args()
+    return args
+
+
+async def main(loop):
+    args = parse_cmdline()
+    influx = FakeInflux(databases=[args.db], latency=args.latency,
+                        error_rate=args.error_rate, host=args.host,
+                        port=args.port)
+    port = await influx.start()
+    print('Fake influx on {0}:{1}, db {2}'.format(args.host, port, args.db))
+    while True:
+        await asyncio.sleep(args.report)
+        print(influx.stats())
+
+
+if __name__ == "__main__":
+    loop = asyncio.get_event_loop()
+    loop.create_task(main(loop))
+    try:
+        loop.run_forever()
+    finally:
+        loop.close()
+    exit(0)
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+#
+# A stand-in venstar thermostat for testing venstar_influx offline.
+# Answers SSDP M-SEARCHes for venstar:thermostat:ecp the way a real unit
+# does (optionally joined to the multicast group on loopback), and serves
+# /query/info and a generated /query/runtimes history over HTTP.
+#
+
+import argparse
+import asyncio
+import json
+import socket
+import struct
+import time
+
+
+SSDP_ADDR = '239.255.255.250'
+VENSTAR_ST = 'venstar:thermostat:ecp'
+
+
+def make_runtimes(count):
+    """ Fake runtime history, one record an hour up to now """
+    now = int(time.time()) // 3600 * 3600
+    runtimes = []
+    for i in range(count):
+        runtimes.append({'ts': now - (count - 1 - i) * 3600,
+                         'heat1': i % 60, 'heat2': 0, 'cool1': (i * 7) % 60,
+                         'cool2': 0, 'aux1': 0, 'aux2': 0, 'fc': 0})
+    return {'runtimes': runtimes}
+
+
+class SSDPResponder(asyncio.DatagramProtocol):
+    """ Answers M-SEARCH for venstars (or ssdp:all) with our Location """
+    def __init__(self, name, location, mac='00:23:a7:00:00:01'):
+        self.name = name
+        self.location = location
+        self.mac = mac
+        self.transport = None
+        self.searches = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        text = data.decode('utf-8', 'replace')
+        if not text.startswith('M-SEARCH'):
+            return
+        if VENSTAR_ST not in text and 'ssdp:all' not in text:
+            return
+        self.searches += 1
+        reply = ('HTTP/1.1 200 OK\r\n'
+                 'Cache-Control: max-age=300\r\n'
+                 'ST: {0}\r\n'
+                 'Location: {1}\r\n'
+                 'USN: ecp:{2}:name:{3}:type:residential\r\n\r\n').format(
+                     VENSTAR_ST, self.location, self.mac, self.name)
+        self.transport.sendto(reply.encode(), addr)
+
+
+def make_ssdp_sock(addr, port):
+    """ Bind the SSDP port, and if addr is multicast join the group on
+        loopback so a search from this machine reaches us.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, 'SO_REUSEPORT'):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    if socket.inet_aton(addr)[0] & 0xF0 == 0xE0:
+        sock.bind(('', port))
+        mreq = struct.pack('4s4s', socket.inet_aton(addr),
+                           socket.inet_aton('127.0.0.1'))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+    else:
+        sock.bind((addr, port))
+    sock.setblocking(False)
+    return sock
+
+
+class FakeVenstar(object):
+    """ SSDP responder plus the two HTTP queries venstar_influx makes """
+    def __init__(self, name='BenchVenstar', records=1000, ssdp_addr='127.0.0.1',
+                 ssdp_port=0, http_port=0):
+        self.name = name
+        self.body = json.dumps(make_runtimes(records)).encode()
+        self.ssdp_addr = ssdp_addr
+        self.ssdp_port = ssdp_port
+        self.http_port = http_port
+        self.server = None
+        self.ssdp = None
+        self.transport = None
+        self.queries = 0
+
+    async def start(self):
+        loop = asyncio.get_event_loop()
+        self.server = await asyncio.start_server(self.handle_http,
+                                                 '127.0.0.1', self.http_port)
+        self.http_port = self.server.sockets[0].getsockname()[1]
+        self.ssdp = SSDPResponder(self.name,
+                                  'http://127.0.0.1:{0}/'.format(self.http_port))
+        self.transport, _ = await loop.create_datagram_endpoint(
+            lambda: self.ssdp, sock=make_ssdp_sock(self.ssdp_addr, self.ssdp_port))
+        self.ssdp_port = self.transport.get_extra_info('socket').getsockname()[1]
+
+    async def stop(self):
+        if self.transport is not None:
+            self.transport.close()
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def handle_http(self, reader, writer):
+        request = await reader.readline()
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        self.queries += 1
+        words = request.decode('latin-1').split()
+        path = words[1] if len(words) > 1 else '/'
+        if path.rstrip('/').endswith('/query/info'):
+            body = json.dumps({'name': self.name, 'mode': 0}).encode()
+            status = '200 OK'
+        elif path.rstrip('/').endswith('/query/runtimes'):
+            body = self.body
+            status = '200 OK'
+        else:
+            body = b'{}'
+            status = '404 Not Found'
+        writer.write('HTTP/1.1 {0}\r\nContent-Type: application/json; charset=utf-8\r\nContent-Length: {1}\r\nConnection: close\r\n\r\n'.format(
+            status, len(body)).encode('latin-1'))
+        writer.write(body)
+        await writer.drain()
+        writer.close()
+
+
+def parse_cmdline():
+    parser = argparse.ArgumentParser(description='Fake venstar for testing')
+
+    parser.add_argument('-v', '--venstar_name', type=str, action='store',
+                        default='BenchVenstar', help='Name to answer to')
+    parser.add_argument('--records', type=int, action='store',
+                        default=1000, help='Hourly runtime records to serve')
+    parser.add_argument('--ssdp_addr', type=str, action='store',
+                        default=SSDP_ADDR,
+                        help='Multicast group to join on loopback, or a unicast address to bind')
+    parser.add_argument('--ssdp_port', type=int, action='store',
+                        default=1900, help='SSDP port')
+    parser.add_argument('--http_port', type=int, action='store',
+                        default=0, help='HTTP port, 0 for any')
+
+    args = parser.parse_args()
+    return args
+
+
+async def main(loop):
+    args = parse_cmdline()
+    venstar = FakeVenstar(args.venstar_name, args.records, args.ssdp_addr,
+                          args.ssdp_port, args.http_port)
+    await venstar.start()
+    print('Fake venstar {0} answering SSDP on {1}:{2}, http on 127.0.0.1:{3}'.format(
+        args.venstar_name, args.ssdp_addr, venstar.ssdp_port, venstar.http_port))
+
+
+if __name__ == "__main__":
+    loop = asyncio.get_event_loop()
+    loop.create_task(main(loop))
+    try:
+        loop.run_forever()
+    finally:
+        loop.close()
+    exit(0)
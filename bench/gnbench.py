@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+#
+# Benchmark the collector hot paths against the fake gnhastd.
+#
+# Each collector is loaded from its directory, wired to a real py-gnhast
+# connection talking to fakegnhastd, and has its callbacks wrapped with a
+# timer.  Every collector runs in its own process so the RSS numbers don't
+# bleed into each other.
+#
+
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import os.path
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from fakegnhastd import FakeGnhastd, FakeDevice, make_population
+from fakeinflux import FakeInflux
+
+
+TOP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COLLECTORS = ['influxcoll', 'presdiff', 'alarmconsole', 'venstar_influx']
+
+
+def parse_cmdline():
+    parser = argparse.ArgumentParser(description='Collector benchmarks')
+
+    parser.add_argument('-c', '--collector', type=str, action='store',
+                        default='all',
+                        choices=['all'] + COLLECTORS,
+                        help='Collector to benchmark')
+    parser.add_argument('--devices', type=int, action='store',
+                        default=500, help='Number of synthetic devices')
+    parser.add_argument('--updates', type=int, action='store',
+                        default=20000, help='Updates (or alarms) to send')
+    parser.add_argument('--rate', type=int, action='store',
+                        default=0, help='Updates per second, 0 for max')
+    parser.add_argument('--timeout', type=int, action='store',
+                        default=120, help='Give up after this many seconds')
+    parser.add_argument('--influx', type=str, action='store',
+                        default='fake', choices=['fake', 'null'],
+                        help='Write to the fake influx, or a null client')
+    parser.add_argument('--influx_latency', type=float, action='store',
+                        default=0.0, help='Fake influx latency per request')
+    parser.add_argument('--influx_error_rate', type=float, action='store',
+                        default=0.0, help='Fraction of fake influx writes that 500')
+    parser.add_argument('--influx_outage', type=float, action='store',
+                        default=0.0, help='Fake influx is down for this many seconds at start')
+    parser.add_argument('--batch_size', type=int, action='store',
+                        default=500, help='influxcoll batch_size')
+    parser.add_argument('--flush_interval', type=float, action='store',
+                        default=1.0, help='influxcoll flush_interval')
+    parser.add_argument('--spool_dir', type=str, action='store',
+                        default=None, help='influxcoll spool_dir')
+
+    args = parser.parse_args()
+    return args
+
+
+def load_collector(name):
+    """ Import a collector script from its directory without running it """
+    path = os.path.join(TOP, name, name + '.py')
+    sys.path.insert(0, os.path.dirname(path))
+    spec = importlib.util.spec_from_file_location(name, path)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+
+def write_conf(port, sections):
+    """ Write a throwaway conf file pointing at the fake gnhastd """
+    cf = tempfile.NamedTemporaryFile('w', suffix='.conf', delete=False)
+    print('gnhastd {', file=cf)
+    print('  hostname = "127.0.0.1"', file=cf)
+    print('  port = {0}'.format(port), file=cf)
+    print('}', file=cf)
+    for section, values in sections.items():
+        print('{0} {{'.format(section), file=cf)
+        for key, val in values.items():
+            print('  {0} = {1}'.format(key, val), file=cf)
+        print('}', file=cf)
+    cf.close()
+    return cf.name
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    idx = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[idx]
+
+
+def rss_kb():
+    """ Current RSS in kB, from /proc if we have it """
+    try:
+        with open('/proc/self/statm') as sf:
+            pages = int(sf.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class CallbackStats(object):
+    """ Collects per-callback timings """
+    def __init__(self):
+        self.times = []
+        self.first = None
+        self.last = None
+        self.done = asyncio.Event()
+        self.expect = 0
+
+    def wrap(self, cb):
+        async def timed_cb(*args):
+            t0 = time.perf_counter()
+            await cb(*args)
+            t1 = time.perf_counter()
+            if self.first is None:
+                self.first = t0
+            self.last = t1
+            self.times.append(t1 - t0)
+            if len(self.times) >= self.expect:
+                self.done.set()
+        return timed_cb
+
+    def report(self, name):
+        times = sorted(self.times)
+        count = len(times)
+        elapsed = (self.last - self.first) if count > 1 else 0.0
+        rate = count / elapsed if elapsed > 0 else 0.0
+        print('{0:14s} {1:8d} cb  {2:10.0f} upd/s  p50 {3:8.1f}us  p99 {4:8.1f}us  rss {5:7d}kB  maxrss {6:7d}kB'.format(
+            name, count, rate,
+            percentile(times, 50) * 1e6, percentile(times, 99) * 1e6,
+            rss_kb(), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+class NullInflux(object):
+    """ Swallows influxcoll writes and counts them """
+    def __init__(self):
+        self.requests = 0
+        self.points = 0
+        self.bytes = 0
+
+    def request(self, url, method='GET', params=None, data=None,
+                expected_response_code=200, headers=None, **kwargs):
+        self.requests += 1
+        if data:
+            self.bytes += len(data)
+            self.points += data.count(b'\n')
+
+
+async def start_influx(args):
+    """ Fire up the fake influx, with whatever misbehaviour was asked for """
+    influx = FakeInflux(databases=['bench'], latency=args.influx_latency,
+                        error_rate=args.influx_error_rate)
+    await influx.start()
+    if args.influx_outage:
+        influx.outage(args.influx_outage)
+    return influx
+
+
+def report_influx(influx, elapsed):
+    stats = influx.stats()
+    print('{0:14s} {1:8d} writes {2:8d} errors {3:10d} points {4:10d} bytes  delivered in {5:.2f}s'.format(
+        '', stats['writes'], stats['errors'], stats['points'],
+        stats['bytes'], elapsed))
+
+
+async def setup_influxcoll(mod, server, gn_conn, stats, args):
+    mod.gn_conn = gn_conn
+    influx = None
+    if args.influx == 'fake':
+        from influxdb import InfluxDBClient
+        influx = await start_influx(args)
+        mod.db_client = InfluxDBClient(host='127.0.0.1', port=influx.port,
+                                       database='bench')
+    else:
+        mod.db_client = NullInflux()
+    mod.db_name = 'bench'
+    spool_max = 64 * 1048576
+    mod.start_writer(args.batch_size, args.flush_interval, args.spool_dir,
+                     spool_max)
+    gn_conn.coll_reg_cb = mod.coll_reg_cb
+    gn_conn.coll_upd_cb = stats.wrap(mod.coll_upd_cb)
+    await gn_conn.gn_ldevs()
+    return influx
+
+
+async def setup_presdiff(mod, server, gn_conn, stats, args):
+    pres = gn_conn.cf_subt.index('pressure')
+    devs = [FakeDevice(uid, uid, gn_conn.cf_type.index('sensor'), pres, 0,
+                       gn_conn.arg_by_subt[pres], 990.0, 1010.0)
+            for uid in ('benchref', 'benchcomp')]
+    server.set_population(devs)
+    mod.gn_conn = gn_conn
+    mod.refuid = 'benchref'
+    mod.compuid = 'benchcomp'
+    diff_dev = gn_conn.new_device('presdiff', 'Pressure Difference',
+                                  gn_conn.cf_type.index('sensor'), pres)
+    diff_dev['proto'] = 16
+    await mod.register_devices(gn_conn)
+    gn_conn.coll_reg_cb = mod.coll_reg_cb
+    gn_conn.coll_upd_cb = stats.wrap(mod.coll_upd_cb)
+    await gn_conn.gn_ldevs(mod.refuid)
+    await gn_conn.gn_ldevs(mod.compuid)
+
+
+async def setup_alarmconsole(mod, server, gn_conn, stats, args):
+    sys.stdout = open(os.devnull, 'w')
+    gn_conn.coll_alarm_cb = stats.wrap(mod.coll_alarm_cb)
+    await gn_conn.gn_listenalarms(1, 0xFFFF)
+
+
+CONF_SECTIONS = {
+    'influxcoll': {'feed': 0, 'recheck': 3600, 'host': '127.0.0.1',
+                   'port': 8086, 'influxdb_name': 'bench'},
+    'presdiff': {'update': 1, 'refuid': '"benchref"',
+                 'compuid': '"benchcomp"'},
+    'alarmconsole': {'minsev': 1, 'channels': 65535},
+}
+
+SETUP = {
+    'influxcoll': setup_influxcoll,
+    'presdiff': setup_presdiff,
+    'alarmconsole': setup_alarmconsole,
+}
+
+
+async def run_one(loop, name, args):
+    from gnhast import gnhast
+
+    server = FakeGnhastd(updates=args.updates, rate=args.rate)
+    port = await server.start()
+    conf = write_conf(port, {name: CONF_SECTIONS[name]})
+
+    gn_conn = gnhast.gnhast(loop, conf)
+    server.set_population(make_population(gn_conn, args.devices))
+    mod = load_collector(name)
+    stats = CallbackStats()
+    stats.expect = args.updates
+
+    await gn_conn.gn_build_client('bench-' + name)
+    asyncio.ensure_future(gn_conn.gnhastd_listener())
+    influx = await SETUP[name](mod, server, gn_conn, stats, args)
+
+    try:
+        await asyncio.wait_for(stats.done.wait(), args.timeout)
+    except asyncio.TimeoutError:
+        print('{0}: timed out with {1} of {2} callbacks'.format(
+            name, len(stats.times), stats.expect), file=sys.__stdout__)
+
+    sys.stdout = sys.__stdout__
+    stats.report(name)
+    if influx is not None:
+        # wait for everything, spooled or not, to land in influx
+        start = time.perf_counter()
+        deadline = start + args.timeout
+        while (influx.points < len(stats.times) and
+               time.perf_counter() < deadline):
+            await asyncio.sleep(0.05)
+        report_influx(influx, time.perf_counter() - start)
+        await influx.stop()
+    elif name == 'influxcoll':
+        db = mod.db_client
+        print('{0:14s} {1:8d} writes {2:10d} points {3:10d} bytes'.format(
+            '', db.requests, db.points, db.bytes))
+    os.unlink(conf)
+    await server.stop()
+
+
+def make_runtimes(count):
+    """ Fake venstar runtime history, one record an hour up to now """
+    now = int(time.time()) // 3600 * 3600
+    runtimes = []
+    for i in range(count):
+        runtimes.append({'ts': now - (count - 1 - i) * 3600,
+                         'heat1': i % 60, 'heat2': 0, 'cool1': (i * 7) % 60,
+                         'cool2': 0, 'aux1': 0, 'aux2': 0, 'fc': 0})
+    return {'runtimes': runtimes}
+
+
+async def run_venstar(loop, args):
+    """ venstar_influx is a one-shot script, so run it for real against the
+        fake influx with a generated history file.
+    """
+    influx = await start_influx(args)
+    data = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False)
+    json.dump(make_runtimes(args.updates), data)
+    data.close()
+
+    cmd = [sys.executable, os.path.join(TOP, 'venstar_influx', 'venstar_influx.py'),
+           '-f', data.name, '-i', '127.0.0.1', '-p', str(influx.port),
+           '-d', 'bench', '-v', 'Bench']
+    start = time.perf_counter()
+    proc = await asyncio.create_subprocess_exec(*cmd)
+    await proc.wait()
+    elapsed = time.perf_counter() - start
+    os.unlink(data.name)
+
+    rate = influx.points / elapsed if elapsed > 0 else 0.0
+    print('{0:14s} {1:8d} rec {2:10.0f} pts/s  {3:.2f}s  child maxrss {4:7d}kB  rc {5}'.format(
+        'venstar_influx', args.updates, rate, elapsed,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        proc.returncode))
+    report_influx(influx, elapsed)
+    await influx.stop()
+
+
+def main():
+    args = parse_cmdline()
+
+    if args.collector == 'all':
+        # one process per collector, so RSS is per collector
+        rc = 0
+        for name in COLLECTORS:
+            cmd = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:]
+            cmd += ['--collector', name]
+            rc |= subprocess.call(cmd)
+        exit(rc)
+
+    loop = asyncio.get_event_loop()
+    try:
+        if args.collector == 'venstar_influx':
+            loop.run_until_complete(run_venstar(loop, args))
+        else:
+            loop.run_until_complete(run_one(loop, args.collector, args))
+    finally:
+        loop.close()
+    exit(0)
+
+
+if __name__ == "__main__":
+    main()
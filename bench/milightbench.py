@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+#
+# Micro-benchmark of milight3coll chg dispatch.
+#
+# Builds the same 5 zones x 6 modes of devices initial_setup writes out for
+# each bridge, then pushes chg callbacks at coll_chg_cb as fast as it will
+# take them, against CommandQueues nobody drains, so only the uid -> route
+# lookup and the queue put are measured.  The old split('-') uid parsing
+# is run the same way for comparison.
+#
+
+import argparse
+import asyncio
+import os
+import random
+import time
+
+from gnbench import CallbackStats, load_collector, write_conf
+
+
+def parse_cmdline():
+    parser = argparse.ArgumentParser(description='milight3coll dispatch benchmark')
+
+    parser.add_argument('--chg', type=int, action='store',
+                        default=200000, help='chg callbacks to dispatch')
+    parser.add_argument('--mac', type=str, action='store',
+                        default='accf230000', help='Bridge MAC prefix in the device uids')
+    parser.add_argument('--bridges', type=int, action='store',
+                        default=1, help='Number of bridges')
+
+    args = parser.parse_args()
+    return args
+
+
+def make_split_chg_cb(mod):
+    """ What coll_chg_cb used to do: parse the uid on every chg """
+    async def split_chg_cb(gn_conn, dev):
+        usplit = dev['uid'].split('-')
+        mode = usplit[2]
+        zone = int(usplit[1].split('e')[1])
+        queue = gn_conn.mi_queues[usplit[0]]
+        queue.pending[(zone, mode)] = mod.MODES[mode](dev['data'])
+    return split_chg_cb
+
+
+def chg_data(rand, uid):
+    """ A valid value for the device """
+    mode = uid.rsplit('-', 1)[1]
+    if mode == 'onoff':
+        return rand.randint(0, 1)
+    if mode == 'disco':
+        return rand.randint(1, 9)
+    if mode == 'color':
+        return rand.randint(0, 255)
+    return rand.random()
+
+
+def make_devices(mod, gn_conn, mac):
+    """ Same devices as milight3coll's initial_setup """
+    for z in range(5):
+        for mode in mod.MODES.keys():
+            devt = 'switch' if mode in ('onoff', 'disco', 'color') else 'dimmer'
+            dev = gn_conn.new_device('{0}-zone{1}-{2}'.format(mac, z, mode),
+                                     'MiLight zone{0} {1}'.format(z, mode),
+                                     gn_conn.cf_type.index(devt),
+                                     gn_conn.cf_subt.index('switch'))
+            dev['data'] = 0
+
+
+async def dispatch(name, cb, gn_conn, devices, count):
+    stats = CallbackStats()
+    stats.expect = count
+    timed = stats.wrap(cb)
+    rand = random.Random(1)
+    for i in range(count):
+        dev = devices[i % len(devices)]
+        dev['data'] = chg_data(rand, dev['uid'])
+        await timed(gn_conn, dev)
+    stats.report(name)
+
+
+async def main(loop):
+    from gnhast import gnhast
+
+    args = parse_cmdline()
+    conf = write_conf(2920, {'milight': {'ip': '127.0.0.1', 'port': 5987,
+                                         'timeout': 5}})
+    gn_conn = gnhast.gnhast(loop, conf)
+    mod = load_collector('milight3coll')
+    macs = ['{0}{1:02x}'.format(args.mac, i + 1) for i in range(args.bridges)]
+    for mac in macs:
+        make_devices(mod, gn_conn, mac)
+
+    start = time.perf_counter()
+    gn_conn.mi_routes = mod.build_routes(gn_conn)
+    print('{0:14s} {1:8d} routes built in {2:.1f}us'.format(
+        'build_routes', len(gn_conn.mi_routes),
+        (time.perf_counter() - start) * 1e6))
+
+    # refresh 0 so nothing is suppressed, every chg reaches a queue
+    gn_conn.mi_queues = dict((mac, mod.CommandQueue(None, 0, gn_conn.mi_routes, 0))
+                             for mac in macs)
+    await dispatch('routed', mod.coll_chg_cb, gn_conn, gn_conn.devices, args.chg)
+    gn_conn.mi_queues = dict((mac, mod.CommandQueue(None, 0, gn_conn.mi_routes, 0))
+                             for mac in macs)
+    await dispatch('split', make_split_chg_cb(mod), gn_conn, gn_conn.devices, args.chg)
+    os.unlink(conf)
+
+
+if __name__ == "__main__":
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(main(loop))
+    finally:
+        loop.close()
+    exit(0)
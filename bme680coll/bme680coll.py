@@ -1,16 +1,43 @@
 #!/usr/bin/env python3
 
-import bme680
 import time
 import argparse
 import asyncio
+import collections
+import json
+import math
 import signal
+import threading
+import os
 import os.path
+from array import array
 from gnhast import gnhast
+try:
+    import bme680
+except ImportError:
+    bme680 = None
 
 
 debug_mode = False
-gas_baseline = 0
+
+# unit is the index of the sensor it came from
+Reading = collections.namedtuple('Reading', ['ts', 'ok', 'gas', 'humidity',
+                                             'temperature', 'pressure', 'unit'],
+                                 defaults=(0,))
+
+# per sensor devices: uid suffix, name, short name, subtype
+DEVICES = [('gas', 'Gas Sensor', 'Gas', 'number'),
+           ('humid', 'Humidity Sensor', 'Humid', 'humid'),
+           ('temp', 'Temperature Sensor', 'Temp', 'temp'),
+           ('pres', 'Pressure Sensor', 'Pres', 'pressure'),
+           ('iaq', 'Air Quality', 'IAQ', 'number')]
+
+# high rate aggregate devices: channel, short name, subtype
+STATS_CHANNELS = [('gas', 'Gas', 'number'),
+                  ('humid', 'Humid', 'humid'),
+                  ('temp', 'Temp', 'temp'),
+                  ('pres', 'Pres', 'pressure')]
+STATS = [('min', 'Min', 'Min'), ('max', 'Max', 'Max'), ('sd', 'StdDev', 'SD')]
 
 
 def parse_cmdline():
@@ -24,7 +51,8 @@ def parse_cmdline():
     parser.add_argument('-m', '--dumpconf', action='store',
                         default='', help='Write out a config file and exit')
     parser.add_argument('-a', '--address', type=str, action='store',
-                        default='0x76', help='i2c address of BME680')
+                        default='0x76',
+                        help='i2c address of BME680, or a list like "0x76,0x77,3:0x76" of [bus:]address')
     parser.add_argument('-b', '--burn_in', type=int, action='store',
                         default=300, help='Seconds to warm up gas sensor')
     parser.add_argument('-p', '--poll_time', type=int, action='store',
@@ -35,19 +63,90 @@ def parse_cmdline():
                         default='127.0.0.1', help='Hostname of gnhastd server')
     parser.add_argument('--port', type=int, action='store',
                         default=2920, help='Port gnhastd listens on')
+    parser.add_argument('--fake_sensor', action='store_true', default=False,
+                        help='Use a fake BME680 instead of the i2c bus')
+    parser.add_argument('--high_rate', action='store_true', default=False,
+                        help='Sample continuously and publish the mean each poll')
+    parser.add_argument('--hr_window', type=int, action='store',
+                        default=64, help='Most samples kept per poll in high rate mode')
+    parser.add_argument('--hr_stats', action='store_true', default=False,
+                        help='Also publish min/max/stddev devices in high rate mode')
 
     args = parser.parse_args()
     return args
 
 
-def init_bme680(bme_addr):
+class SensorUnit(object):
+    """ Everything for one sensor: where it sits on the i2c buses, its UID
+        prefix, the driver object, gas baseline, air quality and high rate
+        window.  label names it in device names and state files; on bus 1
+        it is the address alone, so single sensor setups keep their UIDs.
+    """
+    def __init__(self, bus, addr, label, uid_prefix, single):
+        self.bus = bus
+        self.addr = addr
+        self.label = label
+        self.uid_prefix = uid_prefix
+        self.single = single
+        self.sensor = None
+        self.baseline = None
+        self.iaq = None
+        self.window = None
+        self.devs = {}
+        self.stats_devs = None
+        self.healthy = False
+
+    def device_name(self, name, short_name):
+        if self.single:
+            return 'BME680 ' + name
+        return 'BME680 {0} {1}'.format(self.label, short_name)
+
+    def rrdname(self, suffix):
+        """ None to take it from the device name.  With several sensors
+            those are too alike once cut to 20 characters.
+        """
+        if self.single:
+            return None
+        return (self.label + '_' + suffix)[:20]
+
+
+def parse_sensors(spec, uid_prefix):
+    """ i2c_addr is one address, or a list like "0x76, 0x77, 3:0x76" of
+        [bus:]address, bus 1 being the one on the Pi header.
+    """
+    items = spec.replace(',', ' ').split()
+    units = []
+    for item in items:
+        bus, sep, addr = item.rpartition(':')
+        bus = int(bus) if sep else 1
+        if bus == 1:
+            label = addr
+        else:
+            label = 'b{0}-{1}'.format(bus, addr)
+        units.append(SensorUnit(bus, int(addr, 16), label,
+                                uid_prefix + 'BME680-' + label + '-',
+                                len(items) == 1))
+    return units
+
+
+def client_name(spec):
+    return 'BME680-' + '_'.join(spec.replace(',', ' ').split())
+
+
+def init_bme680(gn_conn, bme_addr, driver, high_rate=False, i2c_device=None):
     try:
-        sensor = bme680.BME680(i2c_addr=bme_addr)
-        sensor.set_humidity_oversample(bme680.OS_2X)
-        sensor.set_pressure_oversample(bme680.OS_1X)
-        sensor.set_temperature_oversample(bme680.OS_8X)
-        sensor.set_filter(bme680.FILTER_SIZE_0)
-        sensor.set_gas_status(bme680.ENABLE_GAS_MEAS)
+        sensor = driver.BME680(i2c_addr=bme_addr, i2c_device=i2c_device)
+        sensor.set_humidity_oversample(driver.OS_2X)
+        sensor.set_temperature_oversample(driver.OS_8X)
+        if high_rate:
+            # reads are back to back, so let the IIR filter take the
+            # short term noise out of temp and pressure
+            sensor.set_pressure_oversample(driver.OS_4X)
+            sensor.set_filter(driver.FILTER_SIZE_3)
+        else:
+            sensor.set_pressure_oversample(driver.OS_1X)
+            sensor.set_filter(driver.FILTER_SIZE_0)
+        sensor.set_gas_status(driver.ENABLE_GAS_MEAS)
         sensor.set_gas_heater_temperature(320)
         sensor.set_gas_heater_duration(150)
         sensor.select_gas_heater_profile(0)
@@ -56,73 +155,428 @@ def init_bme680(bme_addr):
         gn_conn.LOG_ERROR("Cannot initialize BME680 at addr {0}".format(str(bme_addr)))
         return None
 
-async def burn_in_sensor(sensor, burn_in_time, gn_conn):
-    start_time = time.time()
-    curr_time = time.time()
-    burn_in_data = []
-    global gas_baseline
-
-    while curr_time - start_time < burn_in_time:
-        curr_time = time.time()
-        if sensor.get_sensor_data() and sensor.data.heat_stable:
-            gas = sensor.data.gas_resistance
-            burn_in_data.append(gas)
-            gn_conn.LOG_DEBUG("Gas: {0:.2f} Ohms  Time:{1:.2f}".format(gas, curr_time - start_time))
-        await asyncio.sleep(1)
-
-    gas_baseline = sum(burn_in_data[-50:]) / 50.0
-    gn_conn.LOG_DEBUG("Computed gas baseline: {0} Ohms".format(gas_baseline))
-
-    return
-
-
-async def poll_sensor(gn_conn, sensor, poll_time, uid_prefix):
-    gas_dev = gn_conn.find_dev_byuid(uid_prefix + 'gas')
-    hum_dev = gn_conn.find_dev_byuid(uid_prefix + 'humid')
-    temp_dev = gn_conn.find_dev_byuid(uid_prefix + 'temp')
-    pres_dev = gn_conn.find_dev_byuid(uid_prefix + 'pres')
-
-    if gas_dev is None or hum_dev is None or temp_dev is None or pres_dev is None:
-        gn_conn.LOG_ERROR("Cannot find devices")
-        await gn_conn.shutdown(signal.SIGTERM, gn_conn.loop)
 
-    while True:
-        if sensor.get_sensor_data() and sensor.data.heat_stable:
-            gas = sensor.data.gas_resistance
-            hum = sensor.data.humidity
-            # When the gas sensor is running, the temp is high by 2 deg C
-            temp = sensor.data.temperature - 2.0
-            send_temp = temp
-            if gn_conn.config['bme680coll']['tscale'] != 1:
-                send_temp = gn_conn.gn_scale_temp(temp, 1, gn_conn.config['bme680coll']['tscale'])
-            pressure = sensor.data.pressure
-            cur_time = int(time.time())
-
-            gas_dev['data'] = int(gas)
-            gas_dev['lastupd'] = cur_time
-            hum_dev['data'] = hum
-            hum_dev['lastupd'] = cur_time
-            temp_dev['data'] = send_temp
-            temp_dev['lastupd'] = cur_time
-            pres_dev['data'] = pressure
-            pres_dev['lastupd'] = cur_time
-
-            gn_conn.LOG_DEBUG('Gas:{0:.2f} Humid:{1:.2f} Temp:{2:.2f} Pres:{3:.2f}'.format(gas, hum, send_temp, pressure))
-
-            gn_conn.collector_healthy = True
-            await gn_conn.gn_update_device(gas_dev)
-            await gn_conn.gn_update_device(hum_dev)
-            await gn_conn.gn_update_device(temp_dev)
-            await gn_conn.gn_update_device(pres_dev)
+def open_sensors(gn_conn, units, driver, high_rate):
+    """ Initialize every sensor.  Bus 1 is the driver's default, other buses
+        get an SMBus of their own, shared by the sensors on it.
+    """
+    buses = {}
+    for unit in units:
+        i2c_device = None
+        if unit.bus != 1 and driver is bme680:
+            if unit.bus not in buses:
+                try:
+                    import smbus
+                    buses[unit.bus] = smbus.SMBus(unit.bus)
+                except (ImportError, OSError) as error:
+                    gn_conn.LOG_ERROR("Cannot open i2c bus {0}: {1}".format(unit.bus, str(error)))
+                    return False
+            i2c_device = buses[unit.bus]
+        unit.sensor = init_bme680(gn_conn, unit.addr, driver, high_rate, i2c_device)
+        if unit.sensor is None:
+            return False
+    return True
+
+
+class SensorReader(threading.Thread):
+    """ A forced mode read blocks for the oversampling plus the whole gas
+        heater duration, so the reads happen here and timestamped Readings
+        are handed to the event loop through queue.  The sensors are read in
+        turn, spread evenly over interval, so their heater cycles never
+        overlap.  interval may be changed while running.
+    """
+    def __init__(self, units, loop, interval, depth=16):
+        super().__init__(name='bme680-reader', daemon=True)
+        self.units = units
+        self.loop = loop
+        self.interval = interval
+        self.queue = asyncio.Queue(maxsize=depth * len(units))
+        self.stopping = threading.Event()
+
+    def read(self, idx, sensor):
+        try:
+            ok = sensor.get_sensor_data() and sensor.data.heat_stable
+        except OSError:
+            ok = False
+        data = sensor.data
+        return Reading(time.time(), bool(ok), data.gas_resistance,
+                       data.humidity, data.temperature, data.pressure, idx)
+
+    def run(self):
+        next_read = time.monotonic()
+        while not self.stopping.is_set():
+            for idx, unit in enumerate(self.units):
+                reading = self.read(idx, unit.sensor)
+                try:
+                    self.loop.call_soon_threadsafe(self.put, reading)
+                except RuntimeError:
+                    # loop is closed, we are going down
+                    return
+
+                next_read += self.interval / len(self.units)
+                delay = next_read - time.monotonic()
+                if delay < 0:
+                    next_read = time.monotonic()
+                    delay = 0
+                if self.stopping.wait(delay):
+                    return
+
+    def put(self, reading):
+        """ Runs on the loop.  If the consumer fell behind, drop the oldest """
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(reading)
+
+    def stop(self):
+        self.stopping.set()
+
+
+class GasBaseline(object):
+    """ The gas resistance a sensor reads in clean air.  Seeded from the
+        state file if it is fresh enough, otherwise from the mean of the last
+        50 readings of the burn in period, and from then on follows every good
+        reading with an exponential moving average with time constant tau
+        seconds, saved back every save_interval.  value is None until seeded.
+    """
+    def __init__(self, path, tau, save_interval=300):
+        self.path = path
+        self.tau = tau
+        self.save_interval = save_interval
+        self.value = None
+        self.ts = 0
+        self.saved = 0
+        self.burn_until = 0
+        self.burn_data = collections.deque(maxlen=50)
+
+    def load(self, max_age):
+        """ Use the saved baseline if it is younger than max_age seconds """
+        try:
+            with open(self.path) as sf:
+                state = json.load(sf)
+            value = float(state['baseline'])
+            ts = float(state['ts'])
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+        if time.time() - ts > max_age or value <= 0:
+            return False
+        self.value = value
+        self.ts = ts
+        self.saved = ts
+        return True
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        try:
+            with open(tmp, 'w') as sf:
+                json.dump({'baseline': self.value, 'ts': self.ts}, sf)
+            os.replace(tmp, self.path)
+        except OSError:
+            return False
+        self.saved = self.ts
+        return True
+
+    def start_burn_in(self, seconds):
+        self.burn_until = time.time() + seconds
+
+    def update(self, gas, ts):
+        """ Feed a good reading.  Returns True when this finished burn in """
+        if self.value is None:
+            self.burn_data.append(gas)
+            if ts < self.burn_until:
+                return False
+            self.value = sum(self.burn_data) / len(self.burn_data)
+            self.ts = ts
+            self.save()
+            return True
+
+        alpha = 1.0 - math.exp(-max(ts - self.ts, 0) / self.tau)
+        self.value += alpha * (gas - self.value)
+        self.ts = ts
+        if ts - self.saved >= self.save_interval:
+            self.save()
+        return False
+
+
+def track_baseline(gn_conn, baseline, reading):
+    if baseline.update(reading.gas, reading.ts):
+        gn_conn.LOG('Burn-in complete, gas baseline {0:.0f} Ohms'.format(baseline.value))
+        if baseline.saved != baseline.ts:
+            gn_conn.LOG_WARNING('Cannot write gas baseline to {0}'.format(baseline.path))
+
+
+class AirQuality(object):
+    """ Indoor air quality score, 0 to 100 with 100 the best.  Gas
+        resistance against the baseline makes up 1 - hum_weight of it, how
+        far humidity is from hum_baseline percent the rest.  Scores are
+        summed per sample and take() hands back the mean since last time.
+    """
+    def __init__(self, hum_baseline=40.0, hum_weight=0.25):
+        self.hum_baseline = hum_baseline
+        self.hum_weight = hum_weight
+        self.sum = 0.0
+        self.count = 0
+
+    def score(self, gas, hum, gas_baseline):
+        hum_part = self.hum_weight * 100.0
+        hum_offset = hum - self.hum_baseline
+        if hum_offset > 0:
+            hum_score = (100.0 - self.hum_baseline - hum_offset) / (100.0 - self.hum_baseline) * hum_part
+        else:
+            hum_score = (self.hum_baseline + hum_offset) / self.hum_baseline * hum_part
+        hum_score = min(max(hum_score, 0.0), hum_part)
 
+        # more resistance is cleaner air, at or above baseline is perfect
+        if gas < gas_baseline:
+            gas_score = gas / gas_baseline * (100.0 - hum_part)
         else:
-            gn_conn.LOG_WARNING("Sensors not operating")
-            gn_conn.collector_healthy = False
+            gas_score = 100.0 - hum_part
+        return hum_score + gas_score
+
+    def add(self, gas, hum, gas_baseline):
+        # nothing to compare against until burn in is done
+        if gas_baseline is None:
+            return
+        self.sum += self.score(gas, hum, gas_baseline)
+        self.count += 1
+
+    def take(self):
+        if self.count == 0:
+            return None
+        iaq = self.sum / self.count
+        self.sum = 0.0
+        self.count = 0
+        return iaq
+
+
+class SampleWindow(object):
+    """ High rate mode.  An array backed ring buffer per channel holding
+        the readings since the last publish; if more than size arrive in
+        one poll the oldest are overwritten.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.bufs = [array('d', bytes(8 * size)) for i in range(4)]
+        self.head = 0
+        self.count = 0
+        self.last_ts = 0
+
+    def add(self, reading):
+        i = self.head
+        vals = (reading.gas, reading.humidity, reading.temperature,
+                reading.pressure)
+        for buf, val in zip(self.bufs, vals):
+            buf[i] = val
+        self.head = (i + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+        self.last_ts = reading.ts
+
+    def aggregate(self):
+        """ Empty the window.  Returns a Reading of the means and a dict
+            of channel: (min, max, stddev), or (None, None) if it was empty.
+        """
+        n = self.count
+        if n == 0:
+            return None, None
+        means = []
+        stats = {}
+        for (chan, name, subt), buf in zip(STATS_CHANNELS, self.bufs):
+            vals = buf[:n]
+            mean = math.fsum(vals) / n
+            var = math.fsum((v - mean) * (v - mean) for v in vals) / n
+            means.append(mean)
+            stats[chan] = (min(vals), max(vals), math.sqrt(var))
+        self.head = 0
+        self.count = 0
+        return Reading(self.last_ts, True, *means), stats
+
+
+def scale_temp(gn_conn, temp):
+    if gn_conn.config['bme680coll']['tscale'] != 1:
+        return gn_conn.gn_scale_temp(temp, 1, gn_conn.config['bme680coll']['tscale'])
+    return temp
+
+
+def fill_stats_devices(gn_conn, stats_devs, stats, cur_time):
+    """ Set the min/max/stddev devices we have, return the ones set """
+    devs = []
+    for chan, (lo, hi, sd) in stats.items():
+        if chan == 'temp':
+            lo = scale_temp(gn_conn, lo - 2.0)
+            hi = scale_temp(gn_conn, hi - 2.0)
+            # a spread, so only the slope of the scale applies
+            sd = scale_temp(gn_conn, sd) - scale_temp(gn_conn, 0.0)
+        for (stat, name, short_name), val in zip(STATS, (lo, hi, sd)):
+            dev = stats_devs.get(chan + '-' + stat)
+            if dev is None:
+                continue
+            dev['data'] = val
+            dev['lastupd'] = cur_time
+            devs.append(dev)
+    return devs
+
+
+def upd_line(gn_conn, dev):
+    """ The line py-gnhast's gnhast.gn_update_device() sends for a device,
+        upd uid:<uid> <arg>:<value>, dimmers going as dimmer:<value>.  This
+        copies its formatting, so keep the two in step.
+    """
+    if (dev['type'] == gn_conn.cf_type.index('dimmer') and
+            dev['subtype'] == gn_conn.cf_subt.index('switch')):
+        arg = 'dimmer'
+    else:
+        arg = gn_conn.arg_by_subt[dev['subtype']]
+    return 'upd uid:{0} {1}:{2}\n'.format(dev['uid'], arg, dev['data'])
+
+
+async def update_devices(gn_conn, devs):
+    """ Send updates for several devices as one socket write and a single
+        drain, rather than a write and drain per gn_update_device.  The
+        lines are built and written with no await in between, so nothing
+        else sent on the connection can end up in the middle of them.
+    """
+    writer = getattr(gn_conn, 'writer', None)
+    if writer is None:
+        for dev in devs:
+            await gn_conn.gn_update_device(dev)
+        return
 
+    writer.write(''.join(upd_line(gn_conn, dev) for dev in devs).encode())
+    await writer.drain()
+
+
+async def publish(gn_conn, units, unit, reading, stats):
+    devs = unit.devs
+    if reading is not None and reading.ok:
+        gas = reading.gas
+        hum = reading.humidity
+        # When the gas sensor is running, the temp is high by 2 deg C
+        temp = reading.temperature - 2.0
+        send_temp = scale_temp(gn_conn, temp)
+        pressure = reading.pressure
+        cur_time = int(reading.ts)
+
+        devs['gas']['data'] = int(gas)
+        devs['gas']['lastupd'] = cur_time
+        devs['humid']['data'] = hum
+        devs['humid']['lastupd'] = cur_time
+        devs['temp']['data'] = send_temp
+        devs['temp']['lastupd'] = cur_time
+        devs['pres']['data'] = pressure
+        devs['pres']['lastupd'] = cur_time
+
+        gn_conn.LOG_DEBUG('{0} Gas:{1:.2f} Humid:{2:.2f} Temp:{3:.2f} Pres:{4:.2f}'.format(unit.label, gas, hum, send_temp, pressure))
+
+        upd = [devs['gas'], devs['humid'], devs['temp'], devs['pres']]
+        air_quality = unit.iaq.take()
+        if air_quality is not None and devs.get('iaq') is not None:
+            devs['iaq']['data'] = air_quality
+            devs['iaq']['lastupd'] = cur_time
+            upd.append(devs['iaq'])
+        if stats is not None and unit.stats_devs:
+            upd.extend(fill_stats_devices(gn_conn, unit.stats_devs, stats, cur_time))
+
+        unit.healthy = True
+        gn_conn.collector_healthy = all(u.healthy for u in units)
+        await update_devices(gn_conn, upd)
+
+    else:
+        gn_conn.LOG_WARNING("Sensor {0} not operating".format(unit.label))
+        unit.healthy = False
+        gn_conn.collector_healthy = False
+
+
+async def collect_samples(gn_conn, reader, units):
+    """ Hand each reading to its sensor.  In high rate mode it goes into
+        the window for poll_window, otherwise it is published as it comes,
+        paced by the reader thread at one reading per sensor per poll_time.
+    """
+    while True:
+        reading = await reader.queue.get()
+        unit = units[reading.unit]
+        if reading.ok:
+            track_baseline(gn_conn, unit.baseline, reading)
+            unit.iaq.add(reading.gas, reading.humidity, unit.baseline.value)
+        if unit.window is None:
+            await publish(gn_conn, units, unit, reading, None)
+        elif reading.ok:
+            unit.window.add(reading)
+
+
+async def poll_window(gn_conn, units, unit, poll_time):
+    """ High rate mode, publish the window aggregates every poll_time """
+    while True:
         await asyncio.sleep(poll_time)
-
-
-async def initial_setup(args, uid_prefix, loop):
+        reading, stats = unit.window.aggregate()
+        await publish(gn_conn, units, unit, reading, stats)
+
+
+def baseline_path(baseline_dir, label):
+    return os.path.join(baseline_dir, 'bme680coll.{0}.baseline'.format(label))
+
+
+def make_device(gn_conn, uid, name, subt, rrdname=None):
+    dev = gn_conn.new_device(uid, name, gn_conn.cf_type.index('sensor'),
+                             gn_conn.cf_subt.index(subt))
+    if rrdname is None:
+        rrdname = dev['name'].replace(' ', '_')
+    dev['rrdname'] = rrdname[:20]
+    dev['proto'] = 35
+    return dev
+
+
+def ensure_device(gn_conn, uid, name, subt, rrdname=None):
+    """ For devices added after a config file was written.  Returns True
+        if it had to be created.
+    """
+    if gn_conn.find_dev_byuid(uid) is not None:
+        return False
+    make_device(gn_conn, uid, name, subt, rrdname)
+    return True
+
+
+def add_unit_devices(gn_conn, unit, stats):
+    """ Create whichever devices for this sensor don't exist yet, with the
+        high rate min/max/stddev ones if stats.  Returns how many were made.
+    """
+    made = 0
+    for suffix, name, short_name, subt in DEVICES:
+        if ensure_device(gn_conn, unit.uid_prefix + suffix,
+                         unit.device_name(name, short_name), subt,
+                         unit.rrdname(suffix)):
+            made += 1
+    if not stats:
+        return made
+    for chan, name, subt in STATS_CHANNELS:
+        for stat, stat_name, stat_short in STATS:
+            suffix = chan + '-' + stat
+            # a spread isn't a reading, don't let it get unit converted
+            if ensure_device(gn_conn, unit.uid_prefix + suffix,
+                             unit.device_name(name + ' ' + stat_name,
+                                              name + ' ' + stat_short),
+                             'number' if stat == 'sd' else subt,
+                             unit.rrdname(suffix)):
+                made += 1
+    return made
+
+
+def wire_unit_devices(gn_conn, unit, stats):
+    """ Look up the devices a sensor publishes to, False if any are missing """
+    for suffix, name, short_name, subt in DEVICES:
+        unit.devs[suffix] = gn_conn.find_dev_byuid(unit.uid_prefix + suffix)
+        if unit.devs[suffix] is None:
+            gn_conn.LOG_ERROR("Cannot find device {0}".format(unit.uid_prefix + suffix))
+            return False
+    if stats:
+        unit.stats_devs = {}
+        for chan, name, subt in STATS_CHANNELS:
+            for stat, stat_name, stat_short in STATS:
+                suffix = chan + '-' + stat
+                unit.stats_devs[suffix] = gn_conn.find_dev_byuid(unit.uid_prefix + suffix)
+    return True
+
+
+async def initial_setup(args, units, loop):
     print("This is your first run of the collector, setting up")
     print("Using gnhast server at {0}:{1}".format(args.server, str(args.port)))
     try:
@@ -142,39 +596,24 @@ async def initial_setup(args, uid_prefix, loop):
     print('  tscale = C', file=cf)
     print('  i2c_addr = "{0}"'.format(args.address), file=cf)
     print('  burn_in = {0}'.format(str(args.burn_in)), file=cf)
+    print('  baseline_dir = "/usr/local/var"', file=cf)
+    print('  baseline_age = 86400', file=cf)
+    print('  baseline_tau = 43200', file=cf)
+    print('  iaq_hum_baseline = 40', file=cf)
+    print('  iaq_hum_weight = 0.25', file=cf)
+    print('  high_rate = {0}'.format(int(args.high_rate)), file=cf)
+    print('  hr_window = {0}'.format(str(args.hr_window)), file=cf)
+    print('  hr_stats = {0}'.format(int(args.hr_stats)), file=cf)
     print('}', file=cf)
     cf.close()
     print("Wrote initial config file at {0}, connecting to gnhastd".format(args.conf))
 
     gn_conn = gnhast.gnhast(loop, args.conf)
-    await gn_conn.gn_build_client('BME680-{0}'.format(args.address))
+    await gn_conn.gn_build_client(client_name(args.address))
 
     print("Connection established, wiring devices")
-    gas_dev = gn_conn.new_device(uid_prefix + 'gas', 'BME680 Gas Sensor',
-                                 gn_conn.cf_type.index('sensor'),
-                                 gn_conn.cf_subt.index('number'))
-    gas_dev['rrdname'] = gas_dev['name'].replace(' ', '_')[:20]
-    gas_dev['proto'] = 35
-
-    hum_dev = gn_conn.new_device(uid_prefix + 'humid', 'BME680 Humidity Sensor',
-                                 gn_conn.cf_type.index('sensor'),
-                                 gn_conn.cf_subt.index('humid'))
-    hum_dev['rrdname'] = hum_dev['name'].replace(' ', '_')[:20]
-    hum_dev['proto'] = 35
-
-    temp_dev = gn_conn.new_device(uid_prefix + 'temp',
-                                  'BME680 Temperature Sensor',
-                                  gn_conn.cf_type.index('sensor'),
-                                  gn_conn.cf_subt.index('temp'))
-    temp_dev['rrdname'] = temp_dev['name'].replace(' ', '_')[:20]
-    temp_dev['proto'] = 35
-
-    pres_dev = gn_conn.new_device(uid_prefix + 'pres',
-                                  'BME680 Pressure Sensor',
-                                  gn_conn.cf_type.index('sensor'),
-                                  gn_conn.cf_subt.index('pressure'))
-    pres_dev['rrdname'] = pres_dev['name'].replace(' ', '_')[:20]
-    pres_dev['proto'] = 35
+    for unit in units:
+        add_unit_devices(gn_conn, unit, args.high_rate and args.hr_stats)
 
     print("Re-writing config file: {0}".format(args.conf))
     gn_conn.write_conf_file(args.conf)
@@ -197,41 +636,121 @@ async def main(loop):
     if args.debug:
         debug_mode = args.debug
 
-    uid_prefix = args.uid_prefix + 'BME680-' + args.address + '-'
-
     if not os.path.isfile(args.conf):
-        await initial_setup(args, uid_prefix, loop)
+        try:
+            units = parse_sensors(args.address, args.uid_prefix)
+        except ValueError:
+            print('ERROR: Cannot parse i2c address list "{0}"'.format(args.address))
+            exit(1)
+        await initial_setup(args, units, loop)
         exit(0)
 
     gn_conn = gnhast.gnhast(loop, args.conf)
     gn_conn.debug = debug_mode
 
-    await gn_conn.gn_build_client('BME680-{0}'.format(args.address))
+    await gn_conn.gn_build_client(client_name(args.address))
     gn_conn.LOG("BME680 collector starting up")
 
     i2c_addr = gn_conn.config['bme680coll']['i2c_addr']
-    i2c_addr_int = int(i2c_addr, 16)
-    sensor = init_bme680(i2c_addr_int)
-    if sensor is None:
+    try:
+        units = parse_sensors(i2c_addr, args.uid_prefix)
+    except ValueError:
+        units = []
+    if not units:
+        gn_conn.LOG_ERROR('Cannot parse i2c_addr "{0}"'.format(i2c_addr))
+        return
+
+    if args.fake_sensor:
+        import fakebme680
+        driver = fakebme680
+    elif bme680 is None:
+        gn_conn.LOG_ERROR('bme680 module not installed, try --fake_sensor')
+        return
+    else:
+        driver = bme680
+
+    # high rate mode, older config files won't have these
+    high_rate = False
+    hr_window = 64
+    hr_stats = False
+    if 'high_rate' in gn_conn.config['bme680coll']:
+        high_rate = bool(int(gn_conn.config['bme680coll']['high_rate']))
+    if 'hr_window' in gn_conn.config['bme680coll']:
+        hr_window = int(gn_conn.config['bme680coll']['hr_window'])
+    if 'hr_stats' in gn_conn.config['bme680coll']:
+        hr_stats = bool(int(gn_conn.config['bme680coll']['hr_stats']))
+
+    if not open_sensors(gn_conn, units, driver, high_rate):
         gn_conn.LOG_ERROR('Could not intialize BME680')
         return
     burn_in = gn_conn.config['bme680coll']['burn_in']
-    burn_in = 50
     poll_time = gn_conn.config['bme680coll']['update']
 
+    # gas baseline, older config files won't have these
+    baseline_dir = '/usr/local/var'
+    baseline_age = 86400
+    baseline_tau = 43200
+    if 'baseline_dir' in gn_conn.config['bme680coll']:
+        baseline_dir = gn_conn.config['bme680coll']['baseline_dir']
+    if 'baseline_age' in gn_conn.config['bme680coll']:
+        baseline_age = int(gn_conn.config['bme680coll']['baseline_age'])
+    if 'baseline_tau' in gn_conn.config['bme680coll']:
+        baseline_tau = float(gn_conn.config['bme680coll']['baseline_tau'])
+
+    iaq_hum_baseline = 40.0
+    iaq_hum_weight = 0.25
+    if 'iaq_hum_baseline' in gn_conn.config['bme680coll']:
+        iaq_hum_baseline = float(gn_conn.config['bme680coll']['iaq_hum_baseline'])
+    if 'iaq_hum_weight' in gn_conn.config['bme680coll']:
+        iaq_hum_weight = float(gn_conn.config['bme680coll']['iaq_hum_weight'])
+
+    for unit in units:
+        unit.baseline = GasBaseline(baseline_path(baseline_dir, unit.label),
+                                    baseline_tau)
+        if unit.baseline.load(baseline_age):
+            gn_conn.LOG('{0}: using saved gas baseline {1:.0f} Ohms'.format(unit.label, unit.baseline.value))
+        else:
+            # no waiting around, the poller publishes while this runs
+            gn_conn.LOG('{0}: burning in gas sensor for {1} seconds'.format(unit.label, burn_in))
+            unit.baseline.start_burn_in(burn_in)
+        unit.iaq = AirQuality(iaq_hum_baseline, iaq_hum_weight)
+        if high_rate:
+            unit.window = SampleWindow(hr_window)
+
     # set up a signal handler
     for sig in [signal.SIGTERM, signal.SIGINT]:
         loop.add_signal_handler(sig,
                                 lambda: asyncio.ensure_future(gn_conn.shutdown(sig, loop)))
 
+    # config files from before a device existed, or a sensor was added,
+    # need them created
+    added = 0
+    for unit in units:
+        added += add_unit_devices(gn_conn, unit, high_rate and hr_stats)
+    if added:
+        gn_conn.LOG("Added new devices, re-writing config file")
+        gn_conn.write_conf_file(args.conf)
+
+    for unit in units:
+        if not wire_unit_devices(gn_conn, unit, high_rate and hr_stats):
+            await gn_conn.shutdown(signal.SIGTERM, loop)
+            return
+
     # fire up the listener and do gnhastly things..
     asyncio.ensure_future(gn_conn.gnhastd_listener())
     asyncio.ensure_future(register_devices(gn_conn))
 
-    # burn in the sensor and then fire it up
-    await burn_in_sensor(sensor, burn_in, gn_conn)
-    gn_conn.LOG('Burn-in complete, starting poller')
-    asyncio.ensure_future(poll_sensor(gn_conn, sensor, poll_time, uid_prefix))
+    # reads happen in their own thread
+    gn_conn.LOG('Starting poller for {0} sensor(s)'.format(len(units)))
+    if high_rate:
+        # read as fast as the sensors go, publish aggregates every poll
+        reader = SensorReader(units, loop, 0)
+        for unit in units:
+            asyncio.ensure_future(poll_window(gn_conn, units, unit, poll_time))
+    else:
+        reader = SensorReader(units, loop, poll_time)
+    asyncio.ensure_future(collect_samples(gn_conn, reader, units))
+    reader.start()
     return
 
 
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+#
+# A fake BME680 driver with the same interface as the pimoroni bme680
+# module, for running bme680coll without the hardware.  Readings random walk
+# around sane indoor values, and get_sensor_data() blocks for the gas heater
+# duration just like the real thing does.
+#
+
+import random
+import time
+
+
+OS_NONE = 0
+OS_1X = 1
+OS_2X = 2
+OS_4X = 3
+OS_8X = 4
+OS_16X = 5
+
+FILTER_SIZE_0 = 0
+FILTER_SIZE_1 = 1
+FILTER_SIZE_3 = 2
+FILTER_SIZE_7 = 3
+FILTER_SIZE_15 = 4
+FILTER_SIZE_31 = 5
+FILTER_SIZE_63 = 6
+FILTER_SIZE_127 = 7
+
+DISABLE_GAS_MEAS = 0x00
+ENABLE_GAS_MEAS = 0x01
+
+I2C_ADDR_PRIMARY = 0x76
+I2C_ADDR_SECONDARY = 0x77
+
+
+class FieldData(object):
+    """ Same fields as the real driver's data structure """
+    def __init__(self):
+        self.status = 0
+        self.heat_stable = False
+        self.gas_index = 0
+        self.meas_index = 0
+        self.temperature = 22.0
+        self.pressure = 1013.25
+        self.humidity = 40.0
+        self.gas_resistance = 100000.0
+
+
+class BME680(object):
+    """ Fake sensor.  The i2c address is only remembered, and seeds the
+        random walk so two fake sensors don't read the same.
+    """
+    def __init__(self, i2c_addr=I2C_ADDR_PRIMARY, i2c_device=None):
+        self.i2c_addr = i2c_addr
+        self.i2c_device = i2c_device
+        self.data = FieldData()
+        self.rand = random.Random(i2c_addr)
+        self.gas_status = DISABLE_GAS_MEAS
+        self.heater_temp = 320
+        self.heater_duration = 150
+        self.os_temp = OS_8X
+        self.os_hum = OS_2X
+        self.os_pres = OS_4X
+        self.filter = FILTER_SIZE_3
+        self.profile = 0
+        self.reads = 0
+
+    def set_humidity_oversample(self, value):
+        self.os_hum = value
+
+    def set_pressure_oversample(self, value):
+        self.os_pres = value
+
+    def set_temperature_oversample(self, value):
+        self.os_temp = value
+
+    def set_filter(self, value):
+        self.filter = value
+
+    def set_gas_status(self, value):
+        self.gas_status = value
+
+    def set_gas_heater_temperature(self, value, nb_profile=0):
+        self.heater_temp = value
+
+    def set_gas_heater_duration(self, value, nb_profile=0):
+        self.heater_duration = value
+
+    def select_gas_heater_profile(self, value):
+        self.profile = value
+
+    def get_sensor_data(self):
+        """ Block for roughly as long as a forced mode measurement would,
+            then move every reading a little.
+        """
+        wait = 0.002 * (self.os_temp + self.os_hum + self.os_pres)
+        if self.gas_status == ENABLE_GAS_MEAS:
+            wait += self.heater_duration / 1000.0
+        time.sleep(wait)
+
+        self.reads += 1
+        data = self.data
+        data.temperature += self.rand.gauss(0, 0.02)
+        data.humidity = min(100.0, max(0.0, data.humidity + self.rand.gauss(0, 0.05)))
+        data.pressure += self.rand.gauss(0, 0.01)
+        if self.gas_status == ENABLE_GAS_MEAS:
+            # gas resistance climbs as the plate burns in, then wanders
+            target = 250000.0 * (1.0 - 0.5 ** (self.reads / 30.0))
+            data.gas_resistance += (target - data.gas_resistance) * 0.1
+            data.gas_resistance *= 1.0 + self.rand.gauss(0, 0.005)
+            data.heat_stable = self.reads > 3
+        else:
+            data.heat_stable = False
+        return True
@@ -4,14 +4,28 @@ import time
 import argparse
 import asyncio
 import signal
+import os
 import os.path
+import math
+import threading
 from gnhast import gnhast
 from influxdb import InfluxDBClient
-import datetime
+from influxdb.exceptions import InfluxDBClientError
 
 debug_mode = False
 db_client = None
 gn_conn = None
+db_name = None
+write_queue = None
+writer_task = None
+spool = None
+dev_index = {}
+
+# line protocol escapes
+MEASURE_ESCAPE = str.maketrans({'\\': '\\\\', ',': '\\,', ' ': '\\ ',
+                                '\n': '\\n'})
+TAG_ESCAPE = str.maketrans({'\\': '\\\\', ',': '\\,', '=': '\\=', ' ': '\\ ',
+                            '\n': '\\n'})
 
 
 def parse_cmdline():
@@ -43,6 +57,177 @@ def parse_cmdline():
     return args
 
 
+class DevRecord(object):
+    """ What we know about one gnhast device, kept in dev_index by uid.
+        Holds the resolved measurement, tag set and the line protocol prefix
+        built from them, plus the feed rate we asked for (None if we never
+        asked).  Only rebuilt when gnhast re-sends a reg for the device.
+    """
+    __slots__ = ('uid', 'measure', 'tags', 'prefix', 'feed')
+
+    def __init__(self, dev, feed=None):
+        self.uid = dev['uid']
+        self.feed = feed
+        self.refresh(dev)
+
+    def refresh(self, dev):
+        measure = gn_conn.arg_by_subt[dev['subtype']]
+        if dev['type'] == 2 and dev['subtype'] == 1:
+            measure = 'dimmer'
+        tags = {
+            'id': dev['uid'],
+            'name': dev['name'],
+            'type': gn_conn.cf_type[dev['type']],
+            'proto': gn_conn.proto_map[dev['proto']]
+        }
+        if ('tags' in dev and len(dev['tags']) > 1):
+            tags.update(zip(dev['tags'][::2], dev['tags'][1::2]))
+
+        prefix = str(measure).translate(MEASURE_ESCAPE)
+        for key in sorted(tags):
+            val = str(tags[key])
+            if val == '':
+                continue
+            prefix += ',' + str(key).translate(TAG_ESCAPE) + '=' + val.translate(TAG_ESCAPE)
+
+        self.measure = measure
+        self.tags = tags
+        self.prefix = prefix + ' data='
+
+
+class Spool(object):
+    """ Append-only on-disk spool for batches influx refused.
+
+        Batches are appended in line protocol to segment files in spool_dir,
+        a new segment is started every segment_size bytes.  Segments are
+        replayed oldest first, and if the spool grows past max_size the
+        oldest segments are thrown away to make room.  Points influx
+        rejected outright, and segments or lines that can't be read back,
+        are set aside in rejected files (rejected, rotated to rejected.1)
+        for a human to look at, never replayed.  Called from executor
+        threads, so everything is done under a lock.
+    """
+    def __init__(self, spool_dir, max_size, segment_size=1048576):
+        self.spool_dir = spool_dir
+        self.max_size = max_size
+        self.segment_size = segment_size
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.cur = None
+        self.cur_path = None
+        os.makedirs(spool_dir, exist_ok=True)
+        # pick up anything left behind by a previous run
+        self.segments = {}
+        for fname in sorted(os.listdir(spool_dir)):
+            if fname.endswith('.spool'):
+                path = os.path.join(spool_dir, fname)
+                self.segments[path] = os.path.getsize(path)
+
+    def size(self):
+        return sum(self.segments.values())
+
+    def pending(self):
+        return len(self.segments) > 0
+
+    def _rotate(self):
+        if self.cur is not None:
+            self.cur.close()
+        self.seq += 1
+        fname = '{0:013d}-{1:06d}.spool'.format(int(time.time() * 1000),
+                                                self.seq)
+        self.cur_path = os.path.join(self.spool_dir, fname)
+        self.cur = open(self.cur_path, 'a')
+        self.segments[self.cur_path] = 0
+
+    def _close_cur(self):
+        if self.cur is not None:
+            self.cur.close()
+        self.cur = None
+        self.cur_path = None
+
+    def append(self, batch):
+        """ Write a batch to the newest segment, and evict old segments
+            if we went over max_size.  Returns the number of bytes evicted.
+        """
+        data = '\n'.join(batch) + '\n'
+        with self.lock:
+            if self.cur is None or self.segments[self.cur_path] >= self.segment_size:
+                self._rotate()
+            self.cur.write(data)
+            self.cur.flush()
+            os.fsync(self.cur.fileno())
+            self.segments[self.cur_path] += len(data)
+
+            evicted = 0
+            while self.size() > self.max_size and len(self.segments) > 1:
+                oldest = min(self.segments)
+                evicted += self.segments.pop(oldest)
+                os.unlink(oldest)
+            return evicted
+
+    def oldest(self):
+        """ Return the path of the oldest segment, or None.  The segment
+            currently being appended to is closed off first, so we never
+            replay a file that is still growing.
+        """
+        with self.lock:
+            if not self.segments:
+                return None
+            path = min(self.segments)
+            if path == self.cur_path:
+                self._close_cur()
+            return path
+
+    def read(self, path):
+        """ Return (lines, bad) for a segment.  bad are the lines that don't
+            decode or don't end in a timestamp, torn by a crash mid-write.
+        """
+        lines = []
+        bad = []
+        with open(path, 'rb') as sf:
+            for raw in sf:
+                try:
+                    line = raw.decode('utf-8').rstrip('\n')
+                except UnicodeDecodeError:
+                    bad.append(raw.decode('utf-8', 'replace').rstrip('\n'))
+                    continue
+                if not line.strip():
+                    continue
+                if not line.rpartition(' ')[2].isdigit():
+                    bad.append(line)
+                    continue
+                lines.append(line)
+        return lines, bad
+
+    def reject(self, lines):
+        """ Set lines aside in the rejected file, keeping at most two
+            segment_size files of them.
+        """
+        path = os.path.join(self.spool_dir, 'rejected')
+        with self.lock:
+            if os.path.exists(path) and os.path.getsize(path) >= self.segment_size:
+                os.replace(path, path + '.1')
+            with open(path, 'a') as rf:
+                rf.write('\n'.join(lines) + '\n')
+
+    def set_aside(self, path):
+        """ Stop replaying a segment that can't be read, keep it as .bad """
+        with self.lock:
+            self.segments.pop(path, None)
+            if path == self.cur_path:
+                self._close_cur()
+        try:
+            os.replace(path, path + '.bad')
+        except OSError:
+            pass
+
+    def remove(self, path):
+        with self.lock:
+            if path in self.segments:
+                del self.segments[path]
+                os.unlink(path)
+
+
 async def initial_setup(args, loop):
     print("This is your first run of the collector, setting up")
     print("Using gnhast server at {0}:{1}".format(args.server, str(args.port)))
@@ -63,6 +248,16 @@ async def initial_setup(args, loop):
           file=cf)
     print('  feed = 0', file=cf)
     print('  recheck = 3600', file=cf)
+    print('  # flush to influx every batch_size points or flush_interval seconds',
+          file=cf)
+    print('  batch_size = 500', file=cf)
+    print('  flush_interval = 1', file=cf)
+    print('  # points influx refuses are spooled here and replayed later',
+          file=cf)
+    print('  spool_dir = "/usr/local/var/spool/influxcoll"', file=cf)
+    print('  # spool size limit in MB, oldest data is dropped past this',
+          file=cf)
+    print('  spool_max = 64', file=cf)
     print('  host = {0}'.format(args.influxdb_host), file=cf)
     print('  port = {0}'.format(str(args.influxdb_port)), file=cf)
     print('  influxdb_name = {0}'.format(args.influxdb_name), file=cf)
@@ -95,9 +290,7 @@ async def initial_setup(args, loop):
 
 async def ask_for_devicelist(gn_conn):
     """ Ask gnhast for a list of devices every hour
-        Initialize a known_devs list too.
     """
-    gn_conn.known_devs = []
     sleep_time = int(gn_conn.config['influxcoll']['recheck'])
     while True:
         gn_conn.LOG_DEBUG('Executing ldevs')
@@ -109,19 +302,37 @@ async def ask_for_devicelist(gn_conn):
 async def coll_reg_cb(dev):
     """ Gnhast responds with a reg for each device
         respond back to it asking for a feed or cfeed if it's new.
+        A known device just gets its record refreshed, the reg may carry
+        new names or tags.
     """
-    if dev['uid'] in gn_conn.known_devs:
-        gn_conn.LOG_DEBUG('Ignoring known device {0}.'.format(dev['uid']))
+    rec = dev_index.get(dev['uid'])
+    if rec is not None and rec.feed is not None:
+        gn_conn.LOG_DEBUG('Refreshing known device {0}.'.format(dev['uid']))
+        rec.refresh(dev)
+        return
+
+    gn_conn.LOG('Got device {0} asking for a feed.'.format(dev['uid']))
+    feedrate = int(gn_conn.config['influxcoll']['feed'])
+    dev_index[dev['uid']] = DevRecord(dev, feedrate)
+    if feedrate > 0:
+        await gn_conn.gn_feed_device(dev, feedrate)
     else:
-        gn_conn.LOG('Got device {0} asking for a feed.'.format(dev['uid']))
-        feedrate = int(gn_conn.config['influxcoll']['feed'])
-        if feedrate > 0:
-            await gn_conn.gn_feed_device(dev, feedrate)
-        else:
-            await gn_conn.gn_cfeed_device(dev)
-            gn_conn.known_devs.append(dev['uid'])
-        gn_conn.LOG('Asking for a full device dump')
-        await gn_conn.gn_ask_device(dev, full=True)
+        await gn_conn.gn_cfeed_device(dev)
+    gn_conn.LOG('Asking for a full device dump')
+    await gn_conn.gn_ask_device(dev, full=True)
+
+
+def encode_value(value):
+    """ Encode a field value the same way the influx client would """
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, int):
+        return '{0}i'.format(value)
+    if isinstance(value, float):
+        if not math.isfinite(value):
+            return None
+        return repr(value)
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
 
 
 async def coll_upd_cb(dev):
@@ -129,36 +340,202 @@ async def coll_upd_cb(dev):
         with each update, shove it into influxdb
     """
     gn_conn.LOG_DEBUG('Got data for {0} : {1}'.format(dev['uid'], dev['data']))
-    measure = gn_conn.arg_by_subt[dev['subtype']]
-    if dev['type'] == 2 and dev['subtype'] == 1:
-        measure = 'dimmer'
-    json_data = [
-        {
-            "measurement": measure,
-            "tags": {
-                "id": dev['uid'],
-                "name": dev['name'],
-                "type": gn_conn.cf_type[dev['type']],
-                "proto": gn_conn.proto_map[dev['proto']]
-            },
-            "time": datetime.datetime.utcnow().isoformat() + 'Z',
-            "fields": {
-                "data": dev['data']
-            }
-        }
-    ]
-    if ('tags' in dev and len(dev['tags']) > 1):
-        json_data[0]['tags'].update(zip(dev['tags'][::2], dev['tags'][1::2]))
+    rec = dev_index.get(dev['uid'])
+    if rec is None:
+        # update for a device we never saw a reg for, no feed asked
+        rec = dev_index[dev['uid']] = DevRecord(dev)
+    value = encode_value(dev['data'])
+    if value is None:
+        gn_conn.LOG_DEBUG('Skipping non-finite data for {0}'.format(dev['uid']))
+        return
+    write_queue.put_nowait(rec.prefix + value + ' ' + str(time.time_ns()))
+
+
+def write_lines(lines):
+    """ POST a list of line protocol points straight to influx """
+    db_client.request(url='write', method='POST',
+                      params={'db': db_name, 'precision': 'n'},
+                      data=('\n'.join(lines) + '\n').encode('utf-8'),
+                      expected_response_code=204,
+                      headers={'Content-Type': 'application/octet-stream'})
+
+
+def rejected(error):
+    """ True if influx refused the points themselves (field type conflict,
+        bad line, ...).  Sending them again will only fail again.  Influx
+        still writes the good points of a batch it partly rejects.
+    """
+    return (isinstance(error, InfluxDBClientError) and
+            error.code is not None and error.code < 500)
+
+
+def write_batch(batch):
+    """ Push a batch of points to influx.  This runs in an executor
+        thread, never on the event loop.  If influx won't take it, the
+        batch goes to the spool, if we have one, unless influx rejected
+        the points, then they are set aside (or dropped) instead.
+        Returns True if influx took the batch.
+    """
+    try:
+        write_lines(batch)
+        return True
+    except Exception as error:
+        if spool is None:
+            gn_conn.LOG_WARNING('Dropped {0} points, influx write failed: {1}'.format(len(batch), error))
+            return False
+        if rejected(error):
+            gn_conn.LOG_WARNING('Setting aside {0} points influx rejected: {1}'.format(len(batch), error))
+            try:
+                spool.reject(batch)
+            except OSError as error:
+                gn_conn.LOG_ERROR('Cannot write to spool: {0}'.format(error))
+            return False
+        gn_conn.LOG_WARNING('Spooling {0} points, influx write failed: {1}'.format(len(batch), error))
+    try:
+        evicted = spool.append(batch)
+        if evicted:
+            gn_conn.LOG_WARNING('Spool full, dropped {0} bytes of oldest data'.format(evicted))
+    except OSError as error:
+        gn_conn.LOG_ERROR('Cannot write to spool: {0}'.format(error))
+    return False
+
+
+def replay_segment(batch_size):
+    """ Replay the oldest spool segment into influx, batch_size points per
+        write.  The segment is only removed once all of it went in, if influx
+        falls over halfway through the whole segment is tried again later.
+        Influx overwrites identical points, so that is harmless.  Points
+        influx rejects, torn lines and segments that can't be read are set
+        aside so they don't block the rest of the spool.
+        Returns True if the segment was dealt with.
+    """
+    path = spool.oldest()
+    if path is None:
+        return False
+    try:
+        lines, bad = spool.read(path)
+        if bad:
+            gn_conn.LOG_WARNING('Setting aside {0} unreadable lines from {1}'.format(len(bad), path))
+            spool.reject(bad)
+    except OSError as error:
+        gn_conn.LOG_ERROR('Cannot read spool segment {0}, setting it aside: {1}'.format(path, error))
+        spool.set_aside(path)
+        return True
     try:
-        db_client.write_points(json_data)
-    except:
-        pass
-            
+        for i in range(0, len(lines), batch_size):
+            batch = lines[i:i + batch_size]
+            try:
+                write_lines(batch)
+            except InfluxDBClientError as error:
+                if not rejected(error):
+                    raise
+                gn_conn.LOG_WARNING('Setting aside {0} spooled points influx rejected: {1}'.format(len(batch), error))
+                spool.reject(batch)
+    except Exception as error:
+        gn_conn.LOG_WARNING('Spool replay of {0} failed: {1}'.format(path, error))
+        return False
+    spool.remove(path)
+    gn_conn.LOG('Replayed {0} spooled points from {1}'.format(len(lines), path))
+    return True
+
+
+async def spool_replayer(batch_size, replay_interval):
+    """ Every replay_interval seconds, if there is anything in the spool,
+        feed it back to influx one segment at a time.  Each segment is
+        written in an executor and we yield to the loop in between, so a
+        big backlog doesn't starve live updates.
+    """
+    loop = asyncio.get_event_loop()
+    while True:
+        await asyncio.sleep(replay_interval)
+        while spool.pending():
+            try:
+                ok = await loop.run_in_executor(None, replay_segment, batch_size)
+            except Exception as error:
+                gn_conn.LOG_ERROR('Spool replay failed: {0}'.format(error))
+                break
+            if not ok:
+                break
+            await asyncio.sleep(0)
+
+
+async def flush_batch(batch):
+    loop = asyncio.get_event_loop()
+    gn_conn.LOG_DEBUG('Flushing {0} points to influx'.format(len(batch)))
+    await loop.run_in_executor(None, write_batch, batch)
+
+
+async def influx_writer(batch_size, flush_interval):
+    """ Pull points off the write queue and flush them to influx once we
+        have batch_size of them, or the oldest has waited flush_interval
+        seconds, whichever comes first.  A None on the queue flushes what
+        we have and stops the writer.
+    """
+    loop = asyncio.get_event_loop()
+    while True:
+        point = await write_queue.get()
+        if point is None:
+            return
+        batch = [point]
+        deadline = loop.time() + flush_interval
+        while len(batch) < batch_size:
+            if write_queue.empty():
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    point = await asyncio.wait_for(write_queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                point = write_queue.get_nowait()
+            if point is None:
+                await flush_batch(batch)
+                return
+            batch.append(point)
+        await flush_batch(batch)
+
+
+def start_writer(batch_size, flush_interval, spool_dir=None, spool_max=0):
+    """ Create the write queue and fire up the writer, and the spool
+        replayer if we are spooling.
+    """
+    global write_queue
+    global writer_task
+    global spool
+
+    write_queue = asyncio.Queue()
+    if spool_dir:
+        spool = Spool(spool_dir, spool_max)
+        if spool.pending():
+            gn_conn.LOG('Found {0} bytes of spooled data, will replay'.format(spool.size()))
+        asyncio.ensure_future(spool_replayer(batch_size, 10))
+    writer_task = asyncio.ensure_future(influx_writer(batch_size, flush_interval))
+    return writer_task
+
+
+async def shutdown(sig, loop):
+    """ Let the writer finish the batch it is on (it may be halfway through
+        writing it), flush whatever is still queued, then let gnhast shut
+        us down.
+    """
+    if writer_task is not None and not writer_task.done():
+        write_queue.put_nowait(None)
+        await writer_task
+    batch = []
+    while not write_queue.empty():
+        point = write_queue.get_nowait()
+        if point is not None:
+            batch.append(point)
+    if batch:
+        await flush_batch(batch)
+    await gn_conn.shutdown(sig, loop)
 
 
 async def main(loop):
     global debug_mode
     global db_client
+    global db_name
     global gn_conn
 
     try:
@@ -200,12 +577,28 @@ async def main(loop):
         loop.stop()
         print('Cannot find DB named {0} in influx, create please.'.format(gn_conn.config['influxcoll']['influxdb_name']))
         return
-    db_client.switch_database(gn_conn.config['influxcoll']['influxdb_name'])
-        
+    db_name = gn_conn.config['influxcoll']['influxdb_name']
+    db_client.switch_database(db_name)
+
+    # batching knobs, older config files won't have these
+    batch_size = 500
+    flush_interval = 1.0
+    if 'batch_size' in gn_conn.config['influxcoll']:
+        batch_size = int(gn_conn.config['influxcoll']['batch_size'])
+    if 'flush_interval' in gn_conn.config['influxcoll']:
+        flush_interval = float(gn_conn.config['influxcoll']['flush_interval'])
+    spool_dir = None
+    spool_max = 64
+    if 'spool_dir' in gn_conn.config['influxcoll']:
+        spool_dir = gn_conn.config['influxcoll']['spool_dir']
+    if 'spool_max' in gn_conn.config['influxcoll']:
+        spool_max = int(gn_conn.config['influxcoll']['spool_max'])
+    start_writer(batch_size, flush_interval, spool_dir, spool_max * 1048576)
+
     # set up a signal handler
     for sig in [signal.SIGTERM, signal.SIGINT]:
         loop.add_signal_handler(sig,
-                                lambda: asyncio.ensure_future(gn_conn.shutdown(sig, loop)))
+                                lambda: asyncio.ensure_future(shutdown(sig, loop)))
 
     # log reopen on SIGHUP
     loop.add_signal_handler(signal.SIGHUP,
@@ -21,8 +21,11 @@
     - Set disco mode (9 available)
     - Increase/Decrease disco mode speed
     - Get Milight wifi bridge MAC address
+    - Send a scene (several zone/setting changes at once, sent pipelined in one session)
     - ...
 
+  AsyncMilightWifiBridge has the same public functions as coroutines, on an asyncio datagram endpoint.
+
   Used protocol: http://www.limitlessled.com/dev/ (LimitlessLED Wifi Bridge v6.0 section)
 """
 __author__ = 'Quentin Comte-Gaz'
@@ -33,6 +36,7 @@ __python_version__ = "3.+"
 __version__ = "1.0 (2017/04/10)"
 __status__ = "Usable for any project"
 
+import asyncio
 import socket
 import time
 import collections
@@ -100,6 +104,39 @@ class MilightWifiBridge:
   __WIFI_BRIDGE_LAMP_DISCO_MODE_SPEED_UP_CMD = bytearray([0x31, 0x00, 0x00, 0x00, 0x03, 0x02, 0x00, 0x00, 0x00])
   __WIFI_BRIDGE_LAMP_DISCO_MODE_SLOW_DOWN_CMD = bytearray([0x31, 0x00, 0x00, 0x00, 0x03, 0x01, 0x00, 0x00, 0x00])
 
+  # Public functions without value: function name -> (command, zone ID it must be sent to or None)
+  __FIXED_COMMANDS = {
+    'turnOn': (__ON_CMD, None),
+    'turnOff': (__OFF_CMD, None),
+    'turnOnWifiBridgeLamp': (__WIFI_BRIDGE_LAMP_ON_CMD, 0x01),
+    'turnOffWifiBridgeLamp': (__WIFI_BRIDGE_LAMP_OFF_CMD, 0x01),
+    'setNightMode': (__NIGHT_MODE_CMD, None),
+    'setWhiteMode': (__WHITE_MODE_CMD, None),
+    'setWhiteModeBridgeLamp': (__WIFI_BRIDGE_LAMP_WHITE_MODE_CMD, 0x01),
+    'speedUpDiscoMode': (__DISCO_MODE_SPEED_UP_CMD, None),
+    'speedUpDiscoModeBridgeLamp': (__WIFI_BRIDGE_LAMP_DISCO_MODE_SPEED_UP_CMD, 0x01),
+    'slowDownDiscoMode': (__DISCO_MODE_SLOW_DOWN_CMD, None),
+    'slowDownDiscoModeBridgeLamp': (__WIFI_BRIDGE_LAMP_DISCO_MODE_SLOW_DOWN_CMD, 0x01),
+    'link': (__LINK_CMD, None),
+    'unlink': (__UNLINK_CMD, None),
+  }
+
+  # Public functions with a value: function name -> zone ID the command must be sent to or None
+  __VALUE_COMMANDS = {
+    'setDiscoMode': None,
+    'setDiscoModeBridgeLamp': 0x01,
+    'setColor': None,
+    'setColorBridgeLamp': 0x01,
+    'setBrightness': None,
+    'setBrightnessBridgeLamp': 0x01,
+    'setSaturation': None,
+    'setTemperature': None,
+  }
+
+  # Commands of the public functions with a value, indexed by value (0x00 to 0xFF),
+  # built on first use of each function
+  __COMMAND_TABLES = {}
+
   @staticmethod
   def __getSetBridgeLampColorCmd(color):
     """Give 'Set color for bridge lamp' command
@@ -233,23 +270,221 @@ class MilightWifiBridge:
     return bytearray([0x31, 0x00, 0x00, 0x08, 0x05, temperature, 0x00, 0x00, 0x00])
 
   @staticmethod
-  def __calculateCheckSum(command, zoneId):
-    """Calculate request checksum
+  def __buildCommandTable(action):
+    """Build the commands of a public function for every value
+
+    Keyword arguments:
+      action -- (string) Public function name with a value (example: 'setColor')
+
+    return: (list of bytes) The 256 commands, indexed by value
+    """
+    builder = {
+      'setDiscoMode': MilightWifiBridge.__getSetDiscoModeCmd,
+      'setDiscoModeBridgeLamp': MilightWifiBridge.__getSetDiscoModeForBridgeLampCmd,
+      'setColor': MilightWifiBridge.__getSetColorCmd,
+      'setColorBridgeLamp': MilightWifiBridge.__getSetBridgeLampColorCmd,
+      'setBrightness': MilightWifiBridge.__getSetBrightnessCmd,
+      'setBrightnessBridgeLamp': MilightWifiBridge.__getSetBrightnessForBridgeLampCmd,
+      'setSaturation': MilightWifiBridge.__getSetSaturationCmd,
+      'setTemperature': MilightWifiBridge.__getSetTemperatureCmd,
+    }[action]
+    table = [bytes(builder(value)) for value in range(256)]
+    MilightWifiBridge.__COMMAND_TABLES[action] = table
+    return table
+
+  @staticmethod
+  def _getStartSessionMsg():
+    """Give the start session request (shared with AsyncMilightWifiBridge)
+
+    return: (bytearray) Start session request
+    """
+    return MilightWifiBridge.__START_SESSION_MSG
+
+  @staticmethod
+  def _parseStartSessionResponse(data):
+    """Parse a start session response (shared with AsyncMilightWifiBridge)
+
+    Keyword arguments:
+      data -- (bytes) Frame received from the wifi bridge
+
+    return: (MilightWifiBridge.__START_SESSION_RESPONSE) Start session information (responseReceived is False if invalid)
+    """
+    if len(data) != 22:
+      return MilightWifiBridge.__START_SESSION_RESPONSE(responseReceived=False, mac="", sessionId1=-1, sessionId2=-1)
+    return MilightWifiBridge.__START_SESSION_RESPONSE(responseReceived=True,
+                                                      mac=str("{}:{}:{}:{}:{}:{}".format(format(data[7], 'x'),
+                                                                                         format(data[8], 'x'),
+                                                                                         format(data[9], 'x'),
+                                                                                         format(data[10], 'x'),
+                                                                                         format(data[11], 'x'),
+                                                                                         format(data[12], 'x'))),
+                                                      sessionId1=int(data[19]),
+                                                      sessionId2=int(data[20]))
+
+  @staticmethod
+  def _getFrameTemplate(sessionId1, sessionId2):
+    """Give a request frame for a session, to be completed by _fillFrame() (shared with AsyncMilightWifiBridge)
+
+    Keyword arguments:
+      sessionId1 -- (int) First part of the session ID
+      sessionId2 -- (int) Second part of the session ID
+
+    return: (bytearray) Request frame (22 bytes) without sequence number, command, zone and checksum
+    """
+    frame = bytearray(22)
+    frame[0:5] = b'\x80\x00\x00\x00\x11'
+    frame[5] = sessionId1
+    frame[6] = sessionId2
+    return frame
+
+  @staticmethod
+  def _fillFrame(frame, sequenceNumber, command, zoneId):
+    """Complete a request frame in place (shared with AsyncMilightWifiBridge)
 
     Note: Request checksum is equal to SUM(all command bytes and of the zone number) & 0xFF
 
     Keyword arguments:
+      frame -- (bytearray) Request frame given by _getFrameTemplate()
+      sequenceNumber -- (int) Sequence number (between 0x01 and 0xFF)
+      command -- (bytes) Command (9 bytes)
+      zoneId -- (int) Zone ID
+
+    return: (bytearray) The request frame
+    """
+    frame[8] = sequenceNumber
+    frame[10:19] = command
+    frame[19] = zoneId
+    frame[21] = (sum(command) + zoneId) & 0xFF
+    return frame
+
+  @staticmethod
+  def _buildFrame(sessionId1, sessionId2, sequenceNumber, command, zoneId):
+    """Build a request frame (shared with AsyncMilightWifiBridge)
+
+    Keyword arguments:
+      sessionId1 -- (int) First part of the session ID
+      sessionId2 -- (int) Second part of the session ID
+      sequenceNumber -- (int) Sequence number (between 0x01 and 0xFF)
       command -- (bytearray) Command
       zoneId -- (int) Zone ID
 
-    return: (int) Request checksum
+    return: (bytearray) Request frame
+    """
+    return MilightWifiBridge._fillFrame(MilightWifiBridge._getFrameTemplate(sessionId1, sessionId2),
+                                        int(sequenceNumber), command, int(zoneId))
+
+  @staticmethod
+  def _getCommand(action, value=None):
+    """Give the command of a public function (shared with AsyncMilightWifiBridge)
+
+    Keyword arguments:
+      action -- (string) Public function name (example: 'setColor')
+      value -- (int, optional) Value of the function parameter (color, brightness, disco mode, ...)
+
+    return: (bytes or bytearray, int) Command and the zone ID it must be sent to (None if it is the requested zone)
+    """
+    command = MilightWifiBridge.__FIXED_COMMANDS.get(action)
+    if command is not None:
+      return command
+    if action in MilightWifiBridge.__VALUE_COMMANDS:
+      table = MilightWifiBridge.__COMMAND_TABLES.get(action)
+      if table is None:
+        table = MilightWifiBridge.__buildCommandTable(action)
+      return table[int(value) & 0xFF], MilightWifiBridge.__VALUE_COMMANDS[action]
+    raise ValueError("Unknown action {}".format(str(action)))
+
+  # Order of the actions in a scene: light on first (lights off ignore the other commands),
+  # then mode, color, settings, and light off last
+  __SCENE_ORDER = {'turnOn': 0, 'setWhiteMode': 1, 'setNightMode': 1, 'setDiscoMode': 1,
+                   'setColor': 2, 'setTemperature': 2, 'setSaturation': 3, 'setBrightness': 4,
+                   'speedUpDiscoMode': 5, 'slowDownDiscoMode': 5, 'turnOff': 9}
+
+  @staticmethod
+  def _planScene(targets):
+    """Plan the commands of a scene (shared with AsyncMilightWifiBridge)
+
+    The last target given for a zone and setting wins (light on and light off are the same setting,
+    a target on all zones replaces the ones given before it for each zone), a setting given to each of
+    the 4 zones is sent once to eZone.ALL with its most common value (then to the zones given another
+    value) when that saves requests, and the commands are ordered so the
+    lights are on before being set and turned off last, all zones before a single zone.  Lights off
+    on all zones but on in some is sent as lights off to each of the other zones, as lights off goes
+    out after lights on.
+
+    Keyword arguments:
+      targets -- (list of (int, string, int)) Zone ID, public function name (example: 'setColor') and value
+                                              (None for functions without value, like 'turnOn')
+
+    return: (list of (int, string, int)) Zone ID, public function name and value of each command to send
     """
-    checkSum = 0
-    for byteCommand in command:
-      checkSum += byteCommand
-    checkSum += zoneId
+    latest = collections.OrderedDict()
+    for zoneId, action, value in targets:
+      command, forcedZoneId = MilightWifiBridge._getCommand(action, value)
+      if forcedZoneId is not None:
+        raise ValueError("{} is not a zone action".format(str(action)))
+      zoneId = int(zoneId)
+      if zoneId < 0 or zoneId > 4:
+        raise ValueError("Invalid zone {} (must be between 0 and 4)".format(str(zoneId)))
+      setting = 'power' if action in ('turnOn', 'turnOff') else action
+      if zoneId == MilightWifiBridge.eZone.ALL:
+        for zone in range(5):
+          latest.pop((zone, setting), None)
+      latest[(zoneId, setting)] = (zoneId, action, value, bytes(command))
+
+    bySetting = collections.OrderedDict()
+    for (zoneId, setting), target in latest.items():
+      bySetting.setdefault(setting, []).append(target)
+
+    plan = []
+    for setting, settingTargets in bySetting.items():
+      if setting == 'power' and any(target[1] == 'turnOn' for target in settingTargets):
+        allZones = [target for target in settingTargets if target[0] == MilightWifiBridge.eZone.ALL]
+        if allZones and allZones[0][1] == 'turnOff':
+          zonesOn = set(target[0] for target in settingTargets)
+          settingTargets = ([(zone,) + allZones[0][1:] for zone in range(1, 5) if zone not in zonesOn] +
+                            [target for target in settingTargets if target[0] != MilightWifiBridge.eZone.ALL])
+      zones = set(target[0] for target in settingTargets)
+      commands = collections.Counter((target[1], target[3]) for target in settingTargets)
+      (action, command), count = commands.most_common(1)[0]
+      if action == 'turnOff' and count < len(settingTargets):
+        # Lights off on all zones would land after the lights on
+        count = 0
+      if zones == set([1, 2, 3, 4]) and count >= 2:
+        # One request for all zones, then the zones set differently
+        value = next(target[2] for target in settingTargets if (target[1], target[3]) == (action, command))
+        plan.append((MilightWifiBridge.eZone.ALL, action, value))
+        plan.extend(target[:3] for target in settingTargets if (target[1], target[3]) != (action, command))
+      else:
+        plan.extend(target[:3] for target in settingTargets)
+
+    plan.sort(key=lambda target: (MilightWifiBridge.__SCENE_ORDER.get(target[1], 5), target[0]))
+    return plan
+
+  @staticmethod
+  def _sceneSteps(plan):
+    """Split a planned scene in the steps to send one after the other (shared with AsyncMilightWifiBridge)
+
+    Lights on, then the settings for all zones, then the settings for a single zone, then lights
+    off: a step is only started once every request of the previous one is acknowledged (or given
+    up on), so a retried request never lands out of order, and a setting sent to all zones never
+    lands after a zone set differently.
+
+    Keyword arguments:
+      plan -- (list of (int, string, int)) Commands given by _planScene()
 
-    return (checkSum & 0xFF)
+    return: (list of list of int) Index in the plan of the requests of each step
+    """
+    steps = [[], [], [], []]
+    for index, (zoneId, action, value) in enumerate(plan):
+      if action == 'turnOn':
+        steps[0].append(index)
+      elif action == 'turnOff':
+        steps[3].append(index)
+      elif zoneId == MilightWifiBridge.eZone.ALL:
+        steps[1].append(index)
+      else:
+        steps[2].append(index)
+    return [step for step in steps if step]
 
 
   ################################### INIT ####################################
@@ -263,6 +498,9 @@ class MilightWifiBridge:
     """Close connection with Milight wifi bridge"""
     self.__initialized = False
     self.__sequence_number = 0
+    self.__session = None
+    self.__frame = None
+    self.__frame_session = None
 
     try:
       self.__sock.shutdown(socket.SHUT_RDWR)
@@ -320,15 +558,7 @@ class MilightWifiBridge:
       data, addr = self.__sock.recvfrom(1024)
       if len(data) == 22:
         # Parse valid start session response
-        response = MilightWifiBridge.__START_SESSION_RESPONSE(responseReceived=True,
-                                                              mac=str("{}:{}:{}:{}:{}:{}".format(format(data[7], 'x'),
-                                                                                                 format(data[8], 'x'),
-                                                                                                 format(data[9], 'x'),
-                                                                                                 format(data[10], 'x'),
-                                                                                                 format(data[11], 'x'),
-                                                                                                 format(data[12], 'x'))),
-                                                              sessionId1=int(data[19]),
-                                                              sessionId2=int(data[20]))
+        response = MilightWifiBridge._parseStartSessionResponse(data)
         logging.debug("Start session (mac address: {}, session ID 1: {}, session ID 2: {})"
                       .format(str(response.mac), str(response.sessionId1), str(response.sessionId2)))
       else:
@@ -338,9 +568,83 @@ class MilightWifiBridge:
 
     return response
 
+  def __getSession(self):
+    """Give the current session, starting one if there is none yet
+
+    return: (MilightWifiBridge.__START_SESSION_RESPONSE) Session to use (responseReceived is False if none could be started)
+    """
+    if self.__session is None:
+      response = self.__startSession()
+      if not response.responseReceived:
+        return response
+      self.__session = response
+    return self.__session
+
+  def __getFrame(self, session):
+    """Give the request frame of a session, reused for every request sent in it
+
+    Keyword arguments:
+      session -- (MilightWifiBridge.__START_SESSION_RESPONSE) Session to send requests in
+
+    return: (bytearray) Request frame to complete with _fillFrame()
+    """
+    if self.__frame_session is not session:
+      self.__frame = MilightWifiBridge._getFrameTemplate(session.sessionId1, session.sessionId2)
+      self.__frame_session = session
+    return self.__frame
+
+  def __sendFrame(self, command, zoneId, session):
+    """Send one request frame in an already started session and wait for its ACK
+
+    Keyword arguments:
+      command -- (bytearray) Command
+      zoneId -- (int) Zone ID
+      session -- (MilightWifiBridge.__START_SESSION_RESPONSE) Session to send the request in
+
+    return: (bool) Request acknowledged by the wifi bridge (False if timed out or rejected)
+    """
+    # For each request, increment the sequence number (even if the session ID is regenerated)
+    # Sequence number must be between 0x01 and 0xFF
+    self.__sequence_number = (self.__sequence_number + 1) & 0xFF
+    if self.__sequence_number == 0:
+      self.__sequence_number = 1
+
+    # Prepare request frame to send
+    bytesToSend = MilightWifiBridge._fillFrame(self.__getFrame(session), self.__sequence_number,
+                                               command, int(zoneId))
+
+    # Send request frame
+    logging.debug("Sending request with command '{}' with session ID 1 '{}', session ID 2 '{}' and sequence number '{}'"
+                  .format(str(binascii.hexlify(command)), str(session.sessionId1),
+                          str(session.sessionId2), str(self.__sequence_number)))
+    self.__sock.sendto(bytesToSend, (self.__ip, self.__port))
+    try:
+      # Receive response frame, skipping late ACKs of earlier requests
+      while True:
+        data, addr = self.__sock.recvfrom(64)
+        if len(data) != 8:
+          logging.warning("Invalid response size {} instead of 8".format(str(len(data))))
+          return False
+        if data[6] != self.__sequence_number:
+          logging.warning("Invalid sequence number ack {} instead of {}".format(str(data[6]),
+                                                                                self.__sequence_number))
+          continue
+        if data[7] != 0x00:
+          logging.warning("Request rejected by the wifi bridge (error {})".format(str(data[7])))
+          return False
+        logging.debug("Received valid response for previously sent request")
+        return True
+    except socket.timeout:
+      logging.warning("Timed out for response")
+    return False
+
   def __sendRequest(self, command, zoneId):
     """Send command to a specific zone and get response (ACK from the wifi bridge)
 
+    The session is kept and reused for the following requests.  If the wifi bridge
+    does not acknowledge a request or rejects it, a new session is started and the
+    request is sent one more time.
+
     Keyword arguments:
       command -- (bytearray) Command
       zoneId -- (int) Zone ID
@@ -350,48 +654,24 @@ class MilightWifiBridge:
     returnValue = False
 
     # Send request only if valid parameters
-    if len(bytearray(command)) == 9:
+    if len(command) == 9:
       if int(zoneId) >= 0 and int(zoneId) <= 4:
-        startSessionResponse = self.__startSession()
-        if startSessionResponse.responseReceived:
-          # For each request, increment the sequence number (even if the session ID is regenerated)
-          # Sequence number must be between 0x01 and 0xFF
-          self.__sequence_number = (self.__sequence_number + 1) & 0xFF
-          if self.__sequence_number == 0:
-            self.__sequence_number = 1
-
-          # Prepare request frame to send
-          bytesToSend = bytearray([0x80, 0x00, 0x00, 0x00, 0x11, startSessionResponse.sessionId1,
-                                   startSessionResponse.sessionId2, 0x00, int(self.__sequence_number), 0x00])
-          bytesToSend += bytearray(command)
-          bytesToSend += bytearray([int(zoneId), 0x00])
-          bytesToSend += bytearray([int(MilightWifiBridge.__calculateCheckSum(bytearray(command), int(zoneId)))])
-
-          # Send request frame
-          logging.debug("Sending request with command '{}' with session ID 1 '{}', session ID 2 '{}' and sequence number '{}'"
-                        .format(str(binascii.hexlify(command)), str(startSessionResponse.sessionId1),
-                                str(startSessionResponse.sessionId2), str(self.__sequence_number)))
-          self.__sock.sendto(bytesToSend, (self.__ip, self.__port))
-          try:
-            # Receive response frame
-            data, addr = self.__sock.recvfrom(64)
-            if len(data) == 8:
-              if data[6] == self.__sequence_number:
-                returnValue = True
-                logging.debug("Received valid response for previously sent request")
-              else:
-                logging.warning("Invalid sequence number ack {} instead of {}".format(str(data[6]),
-                                                                                      self.__sequence_number))
-            else:
-              logging.warning("Invalid response size {} instead of 8".format(str(len(data))))
-          except socket.timeout:
-            logging.warning("Timed out for response")
-        else:
-          logging.warning("Start session failed")
+        for attempt in range(2):
+          session = self.__getSession()
+          if not session.responseReceived:
+            logging.warning("Start session failed")
+            break
+          returnValue = self.__sendFrame(command, zoneId, session)
+          if returnValue:
+            break
+          # The session may have expired (wifi bridge restarted, ...): negotiate a new one
+          logging.debug("Dropping session ID 1 '{}', session ID 2 '{}'".format(str(session.sessionId1),
+                                                                             str(session.sessionId2)))
+          self.__session = None
       else:
         logging.error("Invalid zone {} (must be between 0 and 4)".format(str(zoneId)))
     else:
-      logging.error("Invalid command size {} instead of 9".format(str(len(bytearray(command)))))
+      logging.error("Invalid command size {} instead of 9".format(str(len(command))))
 
     return returnValue
 
@@ -481,7 +761,7 @@ class MilightWifiBridge:
 
     return: (bool) Request received by the wifi bridge
     """
-    returnValue = self.__sendRequest(MilightWifiBridge.__getSetDiscoModeCmd(discoMode), zoneId)
+    returnValue = self.__sendRequest(MilightWifiBridge._getCommand('setDiscoMode', discoMode)[0], zoneId)
     logging.debug("Set disco mode {} to zone {}: {}".format(str(discoMode), str(zoneId), str(returnValue)))
     return returnValue
 
@@ -493,7 +773,7 @@ class MilightWifiBridge:
 
     return: (bool) Request received by the wifi bridge
     """
-    returnValue = self.__sendRequest(MilightWifiBridge.__getSetDiscoModeForBridgeLampCmd(discoMode), 0x01)
+    returnValue = self.__sendRequest(MilightWifiBridge._getCommand('setDiscoModeBridgeLamp', discoMode)[0], 0x01)
     logging.debug("Set disco mode {} to wifi bridge: {}".format(str(discoMode), str(returnValue)))
     return returnValue
 
@@ -577,7 +857,7 @@ class MilightWifiBridge:
 
     return: (bool) Request received by the wifi bridge
     """
-    returnValue = self.__sendRequest(MilightWifiBridge.__getSetColorCmd(color), zoneId)
+    returnValue = self.__sendRequest(MilightWifiBridge._getCommand('setColor', color)[0], zoneId)
     logging.debug("Set color {} to zone {}: {}".format(str(color), str(zoneId), str(returnValue)))
     return returnValue
 
@@ -591,7 +871,7 @@ class MilightWifiBridge:
 
     return: (bool) Request received by the wifi bridge
     """
-    returnValue = self.__sendRequest(MilightWifiBridge.__getSetBridgeLampColorCmd(color), 0x01)
+    returnValue = self.__sendRequest(MilightWifiBridge._getCommand('setColorBridgeLamp', color)[0], 0x01)
     logging.debug("Set color {} to wifi bridge: {}".format(str(color), str(returnValue)))
     return returnValue
 
@@ -604,7 +884,7 @@ class MilightWifiBridge:
 
     return: (bool) Request received by the wifi bridge
     """
-    returnValue = self.__sendRequest(MilightWifiBridge.__getSetBrightnessCmd(brightness), zoneId)
+    returnValue = self.__sendRequest(MilightWifiBridge._getCommand('setBrightness', brightness)[0], zoneId)
     logging.debug("Set brightness {}% to zone {}: {}".format(str(brightness), str(zoneId), str(returnValue)))
     return returnValue
 
@@ -616,7 +896,7 @@ class MilightWifiBridge:
 
     return: (bool) Request received by the wifi bridge
     """
-    returnValue = self.__sendRequest(MilightWifiBridge.__getSetBrightnessForBridgeLampCmd(brightness), 0x01)
+    returnValue = self.__sendRequest(MilightWifiBridge._getCommand('setBrightnessBridgeLamp', brightness)[0], 0x01)
     logging.debug("Set brightness {}% to the wifi bridge: {}".format(str(brightness), str(returnValue)))
     return returnValue
 
@@ -629,7 +909,7 @@ class MilightWifiBridge:
 
     return: (bool) Request received by the wifi bridge
     """
-    returnValue = self.__sendRequest(MilightWifiBridge.__getSetSaturationCmd(saturation), zoneId)
+    returnValue = self.__sendRequest(MilightWifiBridge._getCommand('setSaturation', saturation)[0], zoneId)
     logging.debug("Set saturation {}% to zone {}: {}".format(str(saturation), str(zoneId), str(returnValue)))
     return returnValue
 
@@ -642,7 +922,7 @@ class MilightWifiBridge:
 
     return: (bool) Request received by the wifi bridge
     """
-    returnValue = self.__sendRequest(MilightWifiBridge.__getSetTemperatureCmd(temperature), zoneId)
+    returnValue = self.__sendRequest(MilightWifiBridge._getCommand('setTemperature', temperature)[0], zoneId)
     logging.debug("Set temperature {}% ({} kelvin) to zone {}: {}"
                   .format(str(temperature), str(int(2700 + 38*temperature)), str(zoneId), str(returnValue)))
     return returnValue
@@ -652,10 +932,397 @@ class MilightWifiBridge:
 
     return: (string) MAC address of the wifi bridge (empty if an error occured)
     """
-    returnValue = self.__startSession().mac
+    response = self.__startSession()
+    if response.responseReceived:
+      # Keep it, the next request does not need to start a session
+      self.__session = response
+    returnValue = response.mac
     logging.debug("Get MAC address: {}".format(str(returnValue)))
     return returnValue
 
+  def sendScene(self, targets):
+    """Request several zone/setting changes at once
+
+    Targets are merged and ordered (see _planScene), then sent in steps (see _sceneSteps):
+    every request of a step is sent in the same session without waiting for the previous
+    ACK, and requests not acknowledged are sent again one by one before the next step.
+
+    Keyword arguments:
+      targets -- (list of (int, string, int)) Zone ID, public function name (example: 'setColor') and value
+                                              (None for functions without value, like 'turnOn')
+
+    return: (list of (int, string, int, bool)) Zone ID, function name, value and request received by the
+            wifi bridge, for each request sent
+    """
+    plan = MilightWifiBridge._planScene(targets)
+    received = [False] * len(plan)
+
+    for step in MilightWifiBridge._sceneSteps(plan):
+      session = self.__getSession()
+      if session.responseReceived:
+        waiting = {}
+        for index in step:
+          zoneId, action, value = plan[index]
+          command, forcedZoneId = MilightWifiBridge._getCommand(action, value)
+          self.__sequence_number = (self.__sequence_number + 1) & 0xFF
+          if self.__sequence_number == 0:
+            self.__sequence_number = 1
+          waiting[self.__sequence_number] = index
+          self.__sock.sendto(MilightWifiBridge._fillFrame(self.__getFrame(session), self.__sequence_number,
+                                                          command, zoneId),
+                             (self.__ip, self.__port))
+        try:
+          while waiting:
+            data, addr = self.__sock.recvfrom(64)
+            if len(data) == 8 and data[6] in waiting:
+              index = waiting.pop(data[6])
+              received[index] = (data[7] == 0x00)
+        except socket.timeout:
+          logging.warning("Timed out for {} scene responses".format(str(len(waiting))))
+
+      # Retry within the step, before the next one goes out
+      for index in step:
+        if not received[index]:
+          zoneId, action, value = plan[index]
+          command, forcedZoneId = MilightWifiBridge._getCommand(action, value)
+          received[index] = self.__sendRequest(command, zoneId)
+
+    logging.debug("Send scene of {} requests: {} received".format(str(len(plan)), str(sum(received))))
+    return [target + (ok,) for target, ok in zip(plan, received)]
+
+
+class AsyncMilightWifiBridge(asyncio.DatagramProtocol):
+  """Milight 3.0 Wifi Bridge class for asyncio
+
+  Same public functions as MilightWifiBridge, as coroutines, sent from an asyncio datagram
+  endpoint so the event loop never blocks on the wifi bridge.  Several requests can be in
+  flight at once, their ACKs are matched by sequence number.  Requests not acknowledged in
+  time are sent again (with a new session if the wifi bridge rejected the current one) up
+  to 'retries' more times, waiting 'backoff', then twice as long, ... between attempts.
+
+  Calling setup() coroutine is necessary in order to make this class work properly.
+  """
+  eZone = MilightWifiBridge.eZone
+  eDiscoMode = MilightWifiBridge.eDiscoMode
+  eTemperature = MilightWifiBridge.eTemperature
+
+  ################################### INIT ####################################
+  def __init__(self, retries=3, backoff=0.1):
+    """Class must be initialized with setup()
+
+    Keyword arguments:
+      retries -- (int, optional) Number of times a request is sent again if not acknowledged
+      backoff -- (float, optional) Wait in sec before the first retry (doubled for each next one)
+    """
+    self.retries = retries
+    self.backoff = backoff
+    self.__transport = None
+    self.__ip = None
+    self.__port = None
+    self.__timeout = 5.0
+    self.__sequence_number = 0
+    self.__session = None
+    self.__frame = None
+    self.__frame_session = None
+    self.__session_lock = None
+    self.__session_waiter = None
+    self.__in_flight = {}
+    self.__last_ack = 0.0
+
+  ################################### SETUP ####################################
+  def close(self):
+    """Close connection with Milight wifi bridge"""
+    if self.__transport is not None:
+      self.__transport.close()
+      self.__transport = None
+      logging.debug("Datagram endpoint closed")
+    self.__session = None
+
+  async def setup(self, ip, port=5987, timeout_sec=5.0):
+    """Initialize the class (can be launched multiple time if setup changed or module crashed)
+
+    Keyword arguments:
+      ip -- (string) IP to communication with the Milight wifi bridge
+      port -- (int, optional) UDP port to communication with the Milight wifi bridge
+      timeout_sec -- (int, optional) Timeout in sec for Milight wifi bridge to answer each attempt of a command
+
+    return: (bool) Milight wifi bridge initialized
+    """
+    self.close()
+    self.__ip = ip
+    self.__port = port
+    self.__timeout = timeout_sec
+    self.__session_lock = asyncio.Lock()
+    try:
+      loop = asyncio.get_event_loop()
+      await loop.create_datagram_endpoint(lambda: self, remote_addr=(ip, port))
+      logging.debug("UDP endpoint initialized with ip {} and port {}".format(str(ip), str(port)))
+    except (OSError, socket.gaierror) as e:
+      logging.error("Impossible to initialize the UDP endpoint with ip {} and port {}: {}".format(str(ip), str(port), str(e)))
+      return False
+    return True
+
+  ######################### DATAGRAM PROTOCOL #########################
+  def connection_made(self, transport):
+    self.__transport = transport
+
+  def connection_lost(self, exc):
+    self.__transport = None
+    self.__fail_all()
+
+  def error_received(self, exc):
+    # ICMP unreachable and friends, the requests in flight will not be answered
+    logging.warning("Error from the wifi bridge endpoint: {}".format(str(exc)))
+    self.__fail_all()
+
+  def datagram_received(self, data, addr):
+    if len(data) == 22:
+      waiter = self.__session_waiter
+      if waiter is not None and not waiter.done():
+        waiter.set_result(MilightWifiBridge._parseStartSessionResponse(data))
+    elif len(data) == 8:
+      self.__last_ack = asyncio.get_event_loop().time()
+      waiter = self.__in_flight.pop(data[6], None)
+      if waiter is None:
+        logging.debug("Ignoring ACK for sequence number {} (late or unknown)".format(str(data[6])))
+      elif not waiter.done():
+        # A non-zero status means the wifi bridge did not take the request (expired session, ...)
+        waiter.set_result(data[7] == 0x00)
+    else:
+      logging.warning("Invalid response size {}".format(str(len(data))))
+
+  def __fail_all(self):
+    for waiter in self.__in_flight.values():
+      if not waiter.done():
+        waiter.set_result(False)
+    self.__in_flight.clear()
+
+  ######################### INTERNAL UTILITY FUNCTIONS #########################
+  async def __startSession(self):
+    """Send start session request and return start session information"""
+    loop = asyncio.get_event_loop()
+    self.__session_waiter = loop.create_future()
+    data_to_send = MilightWifiBridge._getStartSessionMsg()
+    logging.debug("Sending frame '{}' to {}:{}".format(str(binascii.hexlify(data_to_send)),
+                                                     str(self.__ip), str(self.__port)))
+    self.__transport.sendto(data_to_send)
+    try:
+      response = await asyncio.wait_for(self.__session_waiter, self.__timeout)
+      logging.debug("Start session (mac address: {}, session ID 1: {}, session ID 2: {})"
+                    .format(str(response.mac), str(response.sessionId1), str(response.sessionId2)))
+    except asyncio.TimeoutError:
+      logging.warning("Timed out for start session response")
+      response = MilightWifiBridge._parseStartSessionResponse(b'')
+    self.__session_waiter = None
+    return response
+
+  async def __getSession(self):
+    """Give the current session, starting one if there is none (requests waiting for it share it)"""
+    async with self.__session_lock:
+      if self.__session is None:
+        response = await self.__startSession()
+        if not response.responseReceived:
+          return response
+        self.__session = response
+      return self.__session
+
+  def __getFrame(self, session):
+    """Give the request frame of a session, reused for every request sent in it"""
+    if self.__frame_session is not session:
+      self.__frame = MilightWifiBridge._getFrameTemplate(session.sessionId1, session.sessionId2)
+      self.__frame_session = session
+    return self.__frame
+
+  def __nextSequenceNumber(self):
+    # Sequence number must be between 0x01 and 0xFF, and not be used by a request in flight
+    for i in range(255):
+      self.__sequence_number = (self.__sequence_number % 0xFF) + 1
+      if self.__sequence_number not in self.__in_flight:
+        return self.__sequence_number
+    return None
+
+  async def _sendRequest(self, command, zoneId):
+    """Send command to a specific zone and wait for the ACK from the wifi bridge
+
+    Keyword arguments:
+      command -- (bytearray) Command
+      zoneId -- (int) Zone ID
+
+    return: (bool) Request received by the wifi bridge
+    """
+    if len(command) != 9:
+      logging.error("Invalid command size {} instead of 9".format(str(len(command))))
+      return False
+    if int(zoneId) < 0 or int(zoneId) > 4:
+      logging.error("Invalid zone {} (must be between 0 and 4)".format(str(zoneId)))
+      return False
+    if self.__transport is None:
+      logging.error("Not initialized, call setup() first")
+      return False
+
+    loop = asyncio.get_event_loop()
+    for attempt in range(self.retries + 1):
+      if attempt:
+        await asyncio.sleep(self.backoff * (2 ** (attempt - 1)))
+      session = await self.__getSession()
+      if not session.responseReceived:
+        logging.warning("Start session failed")
+        continue
+      sequenceNumber = self.__nextSequenceNumber()
+      if sequenceNumber is None:
+        logging.warning("Too many requests in flight")
+        continue
+
+      waiter = loop.create_future()
+      self.__in_flight[sequenceNumber] = waiter
+      sentAt = loop.time()
+      logging.debug("Sending request with command '{}' with session ID 1 '{}', session ID 2 '{}' and sequence number '{}'"
+                    .format(str(binascii.hexlify(command)), str(session.sessionId1),
+                            str(session.sessionId2), str(sequenceNumber)))
+      # The transport copies what it cannot send right away, the frame can be reused
+      self.__transport.sendto(MilightWifiBridge._fillFrame(self.__getFrame(session), sequenceNumber,
+                                                           command, int(zoneId)))
+      try:
+        if await asyncio.wait_for(waiter, self.__timeout):
+          return True
+        logging.warning("Request rejected by the wifi bridge")
+      except asyncio.TimeoutError:
+        self.__in_flight.pop(sequenceNumber, None)
+        logging.warning("Timed out for response")
+        if self.__last_ack >= sentAt:
+          # Other requests were answered meanwhile: lost packet, the session is fine
+          continue
+      # Maybe the session expired (wifi bridge restarted, ...): negotiate a new one
+      if self.__session is session:
+        self.__session = None
+    return False
+
+  async def _send(self, action, zoneId, value=None):
+    command, forcedZoneId = MilightWifiBridge._getCommand(action, value)
+    if forcedZoneId is not None:
+      zoneId = forcedZoneId
+    returnValue = await self._sendRequest(command, zoneId)
+    logging.debug("{} {} to zone {}: {}".format(action, str(value), str(zoneId), str(returnValue)))
+    return returnValue
+
+  ######################### PUBLIC FUNCTIONS #########################
+  async def turnOn(self, zoneId):
+    """Request 'Light on' to a zone (see MilightWifiBridge.turnOn)"""
+    return await self._send('turnOn', zoneId)
+
+  async def turnOff(self, zoneId):
+    """Request 'Light off' to a zone (see MilightWifiBridge.turnOff)"""
+    return await self._send('turnOff', zoneId)
+
+  async def turnOnWifiBridgeLamp(self):
+    """Request 'Wifi bridge lamp on' (see MilightWifiBridge.turnOnWifiBridgeLamp)"""
+    return await self._send('turnOnWifiBridgeLamp', 0x01)
+
+  async def turnOffWifiBridgeLamp(self):
+    """Request 'Wifi bridge lamp off' (see MilightWifiBridge.turnOffWifiBridgeLamp)"""
+    return await self._send('turnOffWifiBridgeLamp', 0x01)
+
+  async def setNightMode(self, zoneId):
+    """Request 'Night mode' to a zone (see MilightWifiBridge.setNightMode)"""
+    return await self._send('setNightMode', zoneId)
+
+  async def setWhiteMode(self, zoneId):
+    """Request 'White mode' to a zone (see MilightWifiBridge.setWhiteMode)"""
+    return await self._send('setWhiteMode', zoneId)
+
+  async def setWhiteModeBridgeLamp(self):
+    """Request 'White mode' to the bridge lamp (see MilightWifiBridge.setWhiteModeBridgeLamp)"""
+    return await self._send('setWhiteModeBridgeLamp', 0x01)
+
+  async def setDiscoMode(self, discoMode, zoneId):
+    """Request 'Set disco mode' to a zone (see MilightWifiBridge.setDiscoMode)"""
+    return await self._send('setDiscoMode', zoneId, discoMode)
+
+  async def setDiscoModeBridgeLamp(self, discoMode):
+    """Request 'Set disco mode' to the bridge lamp (see MilightWifiBridge.setDiscoModeBridgeLamp)"""
+    return await self._send('setDiscoModeBridgeLamp', 0x01, discoMode)
+
+  async def speedUpDiscoMode(self, zoneId):
+    """Request 'Disco mode speed up' to a zone (see MilightWifiBridge.speedUpDiscoMode)"""
+    return await self._send('speedUpDiscoMode', zoneId)
+
+  async def speedUpDiscoModeBridgeLamp(self):
+    """Request 'Disco mode speed up' to the wifi bridge (see MilightWifiBridge.speedUpDiscoModeBridgeLamp)"""
+    return await self._send('speedUpDiscoModeBridgeLamp', 0x01)
+
+  async def slowDownDiscoMode(self, zoneId):
+    """Request 'Disco mode slow down' to a zone (see MilightWifiBridge.slowDownDiscoMode)"""
+    return await self._send('slowDownDiscoMode', zoneId)
+
+  async def slowDownDiscoModeBridgeLamp(self):
+    """Request 'Disco mode slow down' to wifi bridge (see MilightWifiBridge.slowDownDiscoModeBridgeLamp)"""
+    return await self._send('slowDownDiscoModeBridgeLamp', 0x01)
+
+  async def link(self, zoneId):
+    """Request 'Link' to a zone (see MilightWifiBridge.link)"""
+    return await self._send('link', zoneId)
+
+  async def unlink(self, zoneId):
+    """Request 'Unlink' to a zone (see MilightWifiBridge.unlink)"""
+    return await self._send('unlink', zoneId)
+
+  async def setColor(self, color, zoneId):
+    """Request 'Set color' to a zone (see MilightWifiBridge.setColor)"""
+    return await self._send('setColor', zoneId, color)
+
+  async def setColorBridgeLamp(self, color):
+    """Request 'Set color' to wifi bridge (see MilightWifiBridge.setColorBridgeLamp)"""
+    return await self._send('setColorBridgeLamp', 0x01, color)
+
+  async def setBrightness(self, brightness, zoneId):
+    """Request 'Set brightness' to a zone (see MilightWifiBridge.setBrightness)"""
+    return await self._send('setBrightness', zoneId, brightness)
+
+  async def setBrightnessBridgeLamp(self, brightness):
+    """Request 'Set brightness' to the wifi bridge (see MilightWifiBridge.setBrightnessBridgeLamp)"""
+    return await self._send('setBrightnessBridgeLamp', 0x01, brightness)
+
+  async def setSaturation(self, saturation, zoneId):
+    """Request 'Set saturation' to a zone (see MilightWifiBridge.setSaturation)"""
+    return await self._send('setSaturation', zoneId, saturation)
+
+  async def setTemperature(self, temperature, zoneId):
+    """Request 'Set temperature' to a zone (see MilightWifiBridge.setTemperature)"""
+    return await self._send('setTemperature', zoneId, temperature)
+
+  async def getMacAddress(self):
+    """Request the MAC address of the milight wifi bridge
+
+    return: (string) MAC address of the wifi bridge (empty if an error occured)
+    """
+    if self.__transport is None:
+      logging.error("Not initialized, call setup() first")
+      return ""
+    async with self.__session_lock:
+      response = await self.__startSession()
+      if response.responseReceived:
+        # Keep it, the next request does not need to start a session
+        self.__session = response
+    logging.debug("Get MAC address: {}".format(str(response.mac)))
+    return response.mac
+
+  async def sendScene(self, targets):
+    """Request several zone/setting changes at once (see MilightWifiBridge.sendScene)
+
+    The requests of each step go out pipelined in one session, each retried on its own, and
+    the next step only starts once they are all acknowledged or given up on.
+
+    return: (list of (int, string, int, bool)) Zone ID, function name, value and request received by the
+            wifi bridge, for each request sent
+    """
+    plan = MilightWifiBridge._planScene(targets)
+    received = [False] * len(plan)
+    for step in MilightWifiBridge._sceneSteps(plan):
+      results = await asyncio.gather(*[self._send(plan[index][1], plan[index][0], plan[index][2]) for index in step])
+      for index, ok in zip(step, results):
+        received[index] = ok
+    return [target + (ok,) for target, ok in zip(plan, received)]
+
 
 ################################# HELP FUNCTION ################################
 def __help(func="", filename=__file__):
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+#
+# A stand-in Milight 3.0 (LimitlessLED v6) wifi bridge for testing
+# milight3coll and MilightWifiBridge without the hardware.  Answers start
+# session requests with a 22 byte reply carrying the MAC and session ids, and
+# acks commands with 88 00 00 00 03 00 <seq> <status>, status 0 when the
+# session ids and checksum are good.  Packet loss, latency and bridge
+# restarts (which invalidate the session) can be injected.
+#
+
+import argparse
+import asyncio
+import random
+
+
+class FakeMilight(asyncio.DatagramProtocol):
+    """ The bridge.  drop_rate is the fraction of requests silently ignored,
+        latency is seconds before each reply.  commands keeps
+        (zone, command bytes) of every accepted command when keep is set.
+    """
+    def __init__(self, mac='ac:cf:23:00:00:01', drop_rate=0.0, latency=0.0,
+                 keep=True, host='127.0.0.1', port=0):
+        self.mac = bytes(int(b, 16) for b in mac.split(':'))
+        self.drop_rate = drop_rate
+        self.latency = latency
+        self.keep = keep
+        self.host = host
+        self.port = port
+        self.transport = None
+        self.session = (0, 0)
+        self.commands = []
+        self.sessions = 0
+        self.requests = 0
+        self.rejected = 0
+        self.dropped = 0
+
+    async def start(self):
+        loop = asyncio.get_event_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(
+            lambda: self, local_addr=(self.host, self.port))
+        self.port = self.transport.get_extra_info('sockname')[1]
+        return self.port
+
+    def stop(self):
+        if self.transport is not None:
+            self.transport.close()
+
+    def restart(self):
+        """ Forget the session, like a power cycled bridge """
+        self.session = (0, 0)
+
+    def stats(self):
+        return {'sessions': self.sessions, 'requests': self.requests,
+                'rejected': self.rejected, 'dropped': self.dropped,
+                'commands': len(self.commands)}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if self.drop_rate and random.random() < self.drop_rate:
+            self.dropped += 1
+            return
+        reply = self.handle(data)
+        if reply is None:
+            return
+        if self.latency:
+            asyncio.get_event_loop().call_later(self.latency,
+                                                self.transport.sendto, reply, addr)
+        else:
+            self.transport.sendto(reply, addr)
+
+    def handle(self, data):
+        if len(data) == 27 and data[0] == 0x20:
+            self.sessions += 1
+            self.session = (random.randint(1, 255), random.randint(0, 255))
+            reply = bytearray(22)
+            reply[0:5] = b'\x28\x00\x00\x00\x11'
+            reply[7:13] = self.mac
+            reply[19], reply[20] = self.session
+            return bytes(reply)
+
+        if len(data) == 22 and data[0] == 0x80:
+            self.requests += 1
+            seq = data[8]
+            command = bytes(data[10:19])
+            zone = data[19]
+            checksum = (sum(command) + zone) & 0xFF
+            if (data[5], data[6]) != self.session or data[21] != checksum:
+                self.rejected += 1
+                return bytes([0x88, 0, 0, 0, 0x03, 0, seq, 0x01])
+            if self.keep:
+                self.commands.append((zone, command))
+            return bytes([0x88, 0, 0, 0, 0x03, 0, seq, 0x00])
+        return None
+
+
+def parse_cmdline():
+    parser = argparse.ArgumentParser(description='Fake milight wifi bridge')
+
+    parser.add_argument('--host', type=str, action='store',
+                        default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, action='store',
+                        default=5987, help='Port to listen on')
+    parser.add_argument('--mac', type=str, action='store',
+                        default='ac:cf:23:00:00:01', help='MAC address to report')
+    parser.add_argument('--drop_rate', type=float, action='store',
+                        default=0.0, help='Fraction of requests to ignore')
+    parser.add_argument('--latency', type=float, action='store',
+                        default=0.0, help='Seconds before each reply')
+    parser.add_argument('--report', type=int, action='store',
+                        default=10, help='Print stats every N seconds')
+
+    args = parser.parse_args()
+    return args
+
+
+async def main(loop):
+    args = parse_cmdline()
+    bridge = FakeMilight(args.mac, args.drop_rate, args.latency, keep=False,
+                         host=args.host, port=args.port)
+    port = await bridge.start()
+    print('Fake milight bridge {0} on {1}:{2}'.format(args.mac, args.host, port))
+    while True:
+        await asyncio.sleep(args.report)
+        print(bridge.stats())
+
+
+if __name__ == "__main__":
+    loop = asyncio.get_event_loop()
+    loop.create_task(main(loop))
+    try:
+        loop.run_forever()
+    finally:
+        loop.close()
+    exit(0)
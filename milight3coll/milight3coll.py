@@ -3,10 +3,11 @@
 import time
 import argparse
 import asyncio
+import collections
 import signal
 import os.path
 from gnhast import gnhast
-from MilightWifiBridge import MilightWifiBridge
+from MilightWifiBridge import AsyncMilightWifiBridge
 
 
 debug_mode = False
@@ -30,11 +31,44 @@ def parse_cmdline():
                         default='127.0.0.1', help='IP of milight controller')
     parser.add_argument('--miport', type=int, action='store',
                         default=5987, help='Milight port #')
+    parser.add_argument('--bridges', type=str, action='store',
+                        default='', help='Several milight bridges, as "ip[:port] ip[:port] ..."')
 
     args = parser.parse_args()
     return args
 
 
+def parse_bridges(spec, default_port):
+    """
+    Turn "ip[:port] ip[:port] ..." (commas work too) into [(ip, port)]
+    """
+    bridges = []
+    for item in spec.replace(',', ' ').split():
+        ip, _, port = item.partition(':')
+        bridges.append((ip, int(port) if port else default_port))
+    return bridges
+
+
+async def connect_bridge(ip, port, timeout, retries):
+    """
+    Set up a bridge and ask its MAC, returns (macaddr, bridge), macaddr
+    empty if it didn't answer.  Asked again up to retries times, backing
+    off like the bridge does for commands, so one lost packet at startup
+    doesn't lose the bridge.
+    """
+    milight = AsyncMilightWifiBridge(retries=retries)
+    if not await milight.setup(ip=ip, port=port, timeout_sec=timeout):
+        return '', milight
+    longmac = ''
+    for attempt in range(retries + 1):
+        if attempt:
+            await asyncio.sleep(milight.backoff * (2 ** (attempt - 1)))
+        longmac = await milight.getMacAddress()
+        if longmac:
+            break
+    return longmac.replace(":", ""), milight
+
+
 async def initial_setup(args, loop):
     print("This is your first run of the collector, setting up")
     print("Using gnhast server at {0}:{1}".format(args.server, str(args.port)))
@@ -54,7 +88,12 @@ async def initial_setup(args, loop):
     print('  instance = 1', file=cf)
     print('  port = {0}'.format(str(args.miport)), file=cf)
     print('  ip = {0}'.format(args.miip), file=cf)
+    if args.bridges:
+        print('  bridges = "{0}"'.format(args.bridges), file=cf)
     print('  timeout = 5', file=cf)
+    print('  retries = 3', file=cf)
+    print('  rate = 10', file=cf)
+    print('  refresh = 300', file=cf)
     print('}', file=cf)
     print('misc {', file=cf)
     print('  logfile = "/usr/local/var/log/milight3coll.log"', file=cf)
@@ -77,27 +116,38 @@ async def initial_setup(args, loop):
         'temperature': 'dimmer',
         'onoff': 'switch'
     }
-    print("Connecting to milight to get macaddr at {0}:{1}".format(args.miip, str(args.miport)))
-    milight = MilightWifiBridge()
-    if not milight.setup(ip=args.miip, port=args.miport, timeout_sec=5.0):
-        print("Cannot connect to milight bridge!")
-        loop.stop()
-        exit(1)
-
-    ma = milight.getMacAddress()
-    macaddr = ma.replace(":", "")
-    print("Macaddr = {0}".format(macaddr))
-    
-    # loop to create devices
-    for z in zones:
-        for d in mdevices.keys():
-            duid = '{0}-zone{1}-{2}'.format(macaddr, str(z), d)
-            dname = 'MiLight zone{0} {1}'.format(str(z), d)
-            new_dev = gn_conn.new_device(duid, dname,
-                                         gn_conn.cf_type.index(mdevices[d]),
-                                         gn_conn.cf_subt.index('switch'))
-            new_dev['proto'] = gn_conn.proto_map.index('light')
-            new_dev['rrdname'] = 'milz{0}{1}'.format(str(z), d)
+    bridges = parse_bridges(args.bridges, args.miport)
+    if not bridges:
+        bridges = [(args.miip, args.miport)]
+
+    macaddrs = []
+    for ip, port in bridges:
+        print("Connecting to milight to get macaddr at {0}:{1}".format(ip, str(port)))
+        macaddr, milight = await connect_bridge(ip, port, 5.0, 3)
+        milight.close()
+        if not macaddr:
+            print("Cannot connect to milight bridge!")
+            loop.stop()
+            exit(1)
+        print("Macaddr = {0}".format(macaddr))
+        macaddrs.append(macaddr)
+
+    # loop to create devices, names only carry the mac with several bridges
+    for macaddr in macaddrs:
+        for z in zones:
+            for d in mdevices.keys():
+                duid = '{0}-zone{1}-{2}'.format(macaddr, str(z), d)
+                if len(macaddrs) > 1:
+                    dname = 'MiLight {0} zone{1} {2}'.format(macaddr, str(z), d)
+                    rrdname = 'mi{0}z{1}{2}'.format(macaddr[-6:], str(z), d)
+                else:
+                    dname = 'MiLight zone{0} {1}'.format(str(z), d)
+                    rrdname = 'milz{0}{1}'.format(str(z), d)
+                new_dev = gn_conn.new_device(duid, dname,
+                                             gn_conn.cf_type.index(mdevices[d]),
+                                             gn_conn.cf_subt.index('switch'))
+                new_dev['proto'] = gn_conn.proto_map.index('light')
+                new_dev['rrdname'] = rrdname
 
     print("Re-writing config file: {0}".format(args.conf))
     gn_conn.write_conf_file(args.conf)
@@ -114,41 +164,192 @@ async def register_devices(gn_conn):
         await gn_conn.gn_register_device(dev)
 
 
+def onoff_target(data):
+    if data == 0: #off
+        return ('turnOff', None)
+    if data == 1: #on
+        return ('turnOn', None)
+    return None
+
+
+def switch_target(action):
+    return lambda data: (action, int(data))
+
+
+def dimmer_target(action):
+    # gnhast dimmers are 0.0 - 1.0, the bridge wants a percentage
+    return lambda data: (action, int(round(100 * data)))
+
+
+# device mode -> turns the device data into a bridge (action, value)
+MODES = {
+    'onoff': onoff_target,
+    'disco': switch_target('setDiscoMode'),
+    'color': switch_target('setColor'),
+    'brightness': dimmer_target('setBrightness'),
+    'saturation': dimmer_target('setSaturation'),
+    'temperature': dimmer_target('setTemperature'),
+}
+
+# bridge action -> (device mode, turns the value back into device data)
+ACTIONS = {
+    'turnOn': ('onoff', lambda value: 1),
+    'turnOff': ('onoff', lambda value: 0),
+    'setDiscoMode': ('disco', int),
+    'setColor': ('color', int),
+    'setBrightness': ('brightness', lambda value: value / 100.0),
+    'setSaturation': ('saturation', lambda value: value / 100.0),
+    'setTemperature': ('temperature', lambda value: value / 100.0),
+}
+
+Route = collections.namedtuple('Route', 'uid mac zone mode target')
+
+
+def build_routes(gn_conn):
+    """
+    Map each device uid (<mac>-zone<N>-<mode>) to its Route, so a chg is
+    one dict lookup.  Built once, the device list doesn't change.
+    """
+    routes = {}
+    for dev in gn_conn.devices:
+        try:
+            mac, zone, mode = dev['uid'].split('-')
+            route = Route(dev['uid'], mac, int(zone[len('zone'):]), mode, MODES[mode])
+        except (ValueError, KeyError):
+            gn_conn.LOG_WARNING('Not a milight device: {0}'.format(dev['uid']))
+            continue
+        if not 0 <= route.zone <= 4:
+            gn_conn.LOG_WARNING('No zone {0} on a milight bridge: {1}'.format(route.zone, dev['uid']))
+            continue
+        routes[dev['uid']] = route
+    return routes
+
+
+class CommandQueue(object):
+    """
+    Commands waiting for the bridge, at most one per Route.  A newer
+    value replaces one still waiting (dragging a dimmer sends a burst of
+    chg, only the last matters) and goes to the back of the line, as the
+    scene lets a later target for all zones override earlier ones for a
+    single zone.  drain() sends everything waiting as one scene, so
+    changes to every zone go out once to all zones, no more than rate
+    commands a second.
+
+    The bridge can't be asked what the lights are doing, so state keeps
+    what it last acked for each route.  A command that would set what the
+    bridge already acked less than refresh seconds ago is dropped, and acked
+    state is sent back to gnhast so the devices show it.  While a scene is
+    out, in_flight keeps what it is sending: acked state for that mode may
+    be about to change, so only a repeat of the command on its way out is
+    dropped.
+    """
+    def __init__(self, milight, rate, routes, refresh):
+        self.milight = milight
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.refresh = refresh
+        self.zones = dict(((route.zone, route.mode), route)
+                          for route in routes.values())
+        self.pending = collections.OrderedDict()
+        self.state = {}
+        self.in_flight = {}
+        self.wakeup = asyncio.Event()
+        self.sent = 0
+        self.replaced = 0
+        self.suppressed = 0
+
+    def put(self, route, target):
+        if route in self.in_flight:
+            same = self.in_flight[route] == target
+        elif any(r.mode == route.mode for r in self.in_flight):
+            # zone 0 covers the others, so their acked state is stale too
+            same = False
+        else:
+            shadow = self.state.get(route)
+            same = (shadow is not None and shadow[0] == target and
+                    time.monotonic() - shadow[1] < self.refresh)
+        if same:
+            # already there, and anything still waiting would undo it
+            self.pending.pop(route, None)
+            self.suppressed += 1
+            return
+        if route in self.pending:
+            self.replaced += 1
+            self.pending.move_to_end(route)
+        self.pending[route] = target
+        self.wakeup.set()
+
+    def acked(self, zone, action, value, ok):
+        """
+        Record a scene result in state, return the routes it changed.  zone
+        0 is every zone, and a single zone no longer matches zone 0.
+        """
+        mode, data = ACTIONS[action]
+        zones = [0, 1, 2, 3, 4] if zone == 0 else [zone, 0]
+        now = time.monotonic()
+        changed = []
+        for z in zones:
+            route = self.zones.get((z, mode))
+            if route is None:
+                continue
+            if not ok or z != zone and zone != 0:
+                self.state.pop(route, None)
+                continue
+            self.state[route] = ((action, value), now)
+            changed.append((route, data(value)))
+        return changed
+
+    async def drain(self, gn_conn):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            while self.pending:
+                targets = [(route.zone,) + target
+                           for route, target in self.pending.items()]
+                self.in_flight = dict(self.pending)
+                self.pending.clear()
+
+                try:
+                    results = await self.milight.sendScene(targets)
+                except Exception as error:
+                    # keep draining, and don't trust state for what may or may not have landed
+                    gn_conn.LOG_ERROR('Sending scene to the bridge failed: {0}'.format(error))
+                    for route in self.in_flight:
+                        self.state.pop(route, None)
+                    results = []
+                finally:
+                    self.in_flight = {}
+                for zone, action, value, ok in results:
+                    if not ok:
+                        gn_conn.LOG_WARNING('Bridge did not take {0} {1} for zone {2}'.format(action, value, zone))
+                    for route, data in self.acked(zone, action, value, ok):
+                        dev = gn_conn.find_dev_byuid(route.uid)
+                        if dev is not None:
+                            dev['data'] = data
+                            await gn_conn.gn_update_device(dev)
+                self.sent += len(results)
+                if self.interval:
+                    await asyncio.sleep(self.interval * len(results))
+
+
 async def coll_chg_cb(gn_conn, dev):
     """
-    When we get a chg from gnhast, tell the device to do a thing
+    When we get a chg from gnhast, queue up a thing for the device to do
     """
-    usplit = dev['uid'].split('-')
-    mode = usplit[2]
-    zone = int(usplit[1].split('e')[1])
-
-    if 'onoff' in dev['uid']:
-        if dev['data'] == 0: #off
-            gn_conn.milight.turnOff(zoneId=zone)
-        if dev['data'] == 1: #on
-            gn_conn.milight.turnOn(zoneId=zone)
+    route = gn_conn.mi_routes.get(dev['uid'])
+    if route is None:
+        gn_conn.LOG_WARNING('chg for unknown device {0}'.format(dev['uid']))
         return
-
-    if 'disco' in dev['uid']:
-        gn_conn.milight.setDiscoMode(discoMode=dev['data'], zoneId=zone)
+    queue = gn_conn.mi_queues.get(route.mac)
+    if queue is None:
+        gn_conn.LOG_WARNING('chg for {0}, bridge {1} is not connected'.format(dev['uid'], route.mac))
         return
-
-    if 'color' in dev['uid']:
-        gn_conn.milight.setColor(color=dev['data'], zoneId=zone)
+    target = route.target(dev['data'])
+    if target is None:
+        gn_conn.LOG_WARNING('No bridge command for {0} {1} zone {2}'.format(route.mode, dev['data'], route.zone))
         return
-
-    if 'brightness' in dev['uid']:
-        gn_conn.milight.setBrightness(brightness=int(255*dev['data']),
-                                      zoneId=zone)
-    if 'saturation' in dev['uid']:
-        gn_conn.milight.setSaturation(saturation=int(255*dev['data']),
-                                      zoneId=zone)
-    if 'temperature' in dev['uid']:
-        gn_conn.milight.setTemperature(temperature=int(255*dev['data']),
-                                      zoneId=zone)
+    queue.put(route, target)
 
 
-        
 async def main(loop):
     global debug_mode
 
@@ -175,24 +376,46 @@ async def main(loop):
     await gn_conn.gn_build_client('milight3coll')
     gn_conn.LOG("Milight3coll collector starting up")
 
-    # Read the ip and port from the milight3coll section of the config file
-    gn_conn.mi_ip = gn_conn.config['milight']['ip']
+    # Read the bridges (or the single ip and port) from the milight3coll
+    # section of the config file
     gn_conn.mi_timeout = gn_conn.config['milight']['timeout']
-    gn_conn.mi_port = gn_conn.config['milight']['port']
+    mi_port = 5987
+    if 'port' in gn_conn.config['milight'].keys():
+        mi_port = int(gn_conn.config['milight']['port'])
+    mi_bridges = []
+    if 'bridges' in gn_conn.config['milight'].keys():
+        mi_bridges = parse_bridges(gn_conn.config['milight']['bridges'], mi_port)
+    if not mi_bridges:
+        mi_bridges = [(gn_conn.config['milight']['ip'], mi_port)]
     if 'instance' in gn_conn.config['milight'].keys():
         gn_conn.instance = int(gn_conn.config['milight']['instance'])
-
-    # Connect to the milight
-    gn_conn.milight = MilightWifiBridge()
-    if not gn_conn.milight.setup(ip=gn_conn.mi_ip, port=gn_conn.mi_port,
-                         timeout_sec=gn_conn.mi_timeout):
+    mi_retries = 3
+    if 'retries' in gn_conn.config['milight'].keys():
+        mi_retries = int(gn_conn.config['milight']['retries'])
+    mi_rate = 10
+    if 'rate' in gn_conn.config['milight'].keys():
+        mi_rate = float(gn_conn.config['milight']['rate'])
+    mi_refresh = 300
+    if 'refresh' in gn_conn.config['milight'].keys():
+        mi_refresh = float(gn_conn.config['milight']['refresh'])
+
+    # Connect to the milights, all at once, commands are sent without
+    # blocking the loop.  Each bridge is known by its mac, as in the uids
+    gn_conn.mi_bridges = {}
+    connected = await asyncio.gather(*[connect_bridge(ip, port, gn_conn.mi_timeout, mi_retries)
+                                       for ip, port in mi_bridges])
+    for (ip, port), (macaddr, milight) in zip(mi_bridges, connected):
+        if not macaddr:
+            gn_conn.LOG_ERROR('No answer from milight bridge at {0}:{1}'.format(ip, port))
+            milight.close()
+            continue
+        gn_conn.LOG('Milight bridge {0} at {1}:{2}'.format(macaddr, ip, port))
+        gn_conn.mi_bridges[macaddr] = milight
+    if not gn_conn.mi_bridges:
         print("Cannot connect to milight bridge!")
         loop.stop()
         exit(1)
 
-    gn_conn.mi_longmac = gn_conn.milight.getMacAddress()
-    gn_conn.mi_macaddr = gn_conn.mi_longmac.replace(":", "")
-
     # set up a signal handler
     for sig in [signal.SIGTERM, signal.SIGINT]:
         loop.add_signal_handler(sig,
@@ -205,7 +428,16 @@ async def main(loop):
     asyncio.ensure_future(gn_conn.gnhastd_listener())
     asyncio.ensure_future(register_devices(gn_conn))
 
-    # These are write only devices.  Just wire up a chg callback
+    # These are write only devices.  Just wire up a chg callback, which
+    # queues commands for each bridge's drain task to send
+    gn_conn.mi_routes = build_routes(gn_conn)
+    gn_conn.mi_queues = {}
+    for macaddr, milight in gn_conn.mi_bridges.items():
+        routes = dict((uid, route) for uid, route in gn_conn.mi_routes.items()
+                      if route.mac == macaddr)
+        gn_conn.mi_queues[macaddr] = CommandQueue(milight, mi_rate, routes,
+                                                  mi_refresh)
+        asyncio.ensure_future(gn_conn.mi_queues[macaddr].drain(gn_conn))
     gn_conn.coll_chg_cb = coll_chg_cb
 
     return
@@ -4,11 +4,26 @@ import time
 import argparse
 from influxdb import InfluxDBClient
 import datetime
+import asyncio
+import bisect
+import codecs
+import concurrent.futures
+import itertools
 import json
-import subprocess
+import os
+import queue
+import socket
+import struct
+import threading
 import urllib.request
 
 
+SSDP_ADDR = '239.255.255.250'
+SSDP_PORT = 1900
+VENSTAR_ST = 'venstar:thermostat:ecp'
+url_cache_lock = threading.Lock()
+
+
 def parse_cmdline():
     parser = argparse.ArgumentParser(description='Venstar Stats Tool')
     parser.add_argument('-v', '--venstar_name', type=str, action='store',
@@ -40,44 +55,504 @@ def parse_cmdline():
     parser.add_argument('-D', '--dry_run', action='store_true',
                         default=False,
                         help='Dry-Run, no datapoints will be written')
+    parser.add_argument('-c', '--chunk_size', type=int, action='store',
+                        default=5000,
+                        help='Points per influx write (5000)')
+    parser.add_argument('-I', '--incremental', action='store_true',
+                        default=False,
+                        help='Only send records newer than the last run')
+    parser.add_argument('-t', '--targets', type=str, action='store',
+                        default=None,
+                        help='File listing several venstars, "name [url]" per line')
+    parser.add_argument('-w', '--workers', type=int, action='store',
+                        default=4,
+                        help='How many venstars to fetch at once (4)')
+    parser.add_argument('--delay', type=int, action='store',
+                        default=5,
+                        help='Seconds to let a venstar rest between queries (5)')
+    parser.add_argument('--url_cache', type=str, action='store',
+                        default='/usr/local/var/venstar_influx.urls',
+                        help='Where discovered venstar URLs are remembered')
+    parser.add_argument('--ssdp_timeout', type=int, action='store',
+                        default=65,
+                        help='Seconds to look for a venstar with SSDP (65)')
+    parser.add_argument('--ssdp_addr', type=str, action='store',
+                        default=SSDP_ADDR,
+                        help='Where to send SSDP searches ({0})'.format(SSDP_ADDR))
+    parser.add_argument('--ssdp_port', type=int, action='store',
+                        default=SSDP_PORT,
+                        help='SSDP port ({0})'.format(SSDP_PORT))
+    parser.add_argument('-s', '--state_file', type=str, action='store',
+                        default='/usr/local/var/venstar_influx.state',
+                        help='Where incremental mode remembers the last record sent')
 
     args = parser.parse_args()
     return args
 
 
-def run_notify(venstar_name):
-    notify_cmd = "notify_listen -t 65 2> /dev/null | grep -B 1 name:" + venstar_name + ": | grep ^Location | sort -u | awk '{print $2}' | tr -d '\r'"
+def ssdp_location(data, venstar_name):
+    """ If an SSDP packet (search response or NOTIFY) is from the venstar we
+        want, return its Location, else None.  Venstars put name:<name>: in
+        their USN.
+    """
+    try:
+        lines = data.decode('utf-8', 'replace').split('\r\n')
+    except AttributeError:
+        return None
+    tag = 'name:' + venstar_name + ':'
+    location = None
+    matched = False
+    for line in lines[1:]:
+        key, _, val = line.partition(':')
+        if key.strip().lower() == 'location':
+            location = val.strip()
+        if tag in line:
+            matched = True
+    if matched:
+        return location
+    return None
+
+
+class SSDPListener(asyncio.DatagramProtocol):
+    """ Resolves found with the Location of the first packet that matches """
+    def __init__(self, venstar_name, found):
+        self.venstar_name = venstar_name
+        self.found = found
+
+    def datagram_received(self, data, addr):
+        location = ssdp_location(data, self.venstar_name)
+        if location and not self.found.done():
+            self.found.set_result(location)
+
+
+def make_notify_sock(ssdp_addr, ssdp_port):
+    """ Socket joined to the SSDP multicast group, to hear NOTIFYs """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, 'SO_REUSEPORT'):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(('', ssdp_port))
+    mreq = struct.pack('4sl', socket.inet_aton(ssdp_addr), socket.INADDR_ANY)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+    sock.setblocking(False)
+    return sock
+
+
+async def ssdp_discover(venstar_name, timeout, ssdp_addr=SSDP_ADDR,
+                        ssdp_port=SSDP_PORT, interval=5):
+    """ M-SEARCH for venstars every interval seconds, and listen for their
+        NOTIFYs, until the one named venstar_name shows up or timeout runs
+        out.  Returns its Location URL, or '' if it never answered.
+    """
+    loop = asyncio.get_event_loop()
+    found = loop.create_future()
+    transports = []
+
+    search = ('M-SEARCH * HTTP/1.1\r\n'
+              'HOST: {0}:{1}\r\n'
+              'MAN: "ssdp:discover"\r\n'
+              'MX: 2\r\n'
+              'ST: {2}\r\n\r\n').format(ssdp_addr, ssdp_port, VENSTAR_ST).encode()
+
+    try:
+        if socket.inet_aton(ssdp_addr)[0] & 0xF0 == 0xE0:
+            try:
+                transport, _ = await loop.create_datagram_endpoint(
+                    lambda: SSDPListener(venstar_name, found),
+                    sock=make_notify_sock(ssdp_addr, ssdp_port))
+                transports.append(transport)
+            except OSError as e:
+                print("Cannot listen for SSDP notify, searching only: {0}".format(str(e)))
+
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: SSDPListener(venstar_name, found),
+            local_addr=('0.0.0.0', 0))
+        transports.append(transport)
+        sock = transport.get_extra_info('socket')
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+
+        deadline = loop.time() + timeout
+        while not found.done() and loop.time() < deadline:
+            transport.sendto(search, (ssdp_addr, ssdp_port))
+            try:
+                await asyncio.wait_for(asyncio.shield(found),
+                                       min(interval, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        for transport in transports:
+            transport.close()
+
+    if found.done():
+        return found.result().rstrip('/')
+    return ''
+
+
+def load_url_cache(url_cache):
+    try:
+        with open(url_cache) as uf:
+            return json.load(uf)
+    except (OSError, ValueError):
+        return {}
+
+
+def find_venstar(venstar_name, args):
+    """ Find the URL of a venstar by name.  The last URL we found it at is
+        tried first, and only trusted if the venstar there still answers to
+        that name, otherwise go look for it with SSDP and remember where it
+        was.
+    """
+    with url_cache_lock:
+        cached = load_url_cache(args.url_cache).get(venstar_name)
+    if cached:
+        try:
+            if ask_name(cached) == venstar_name:
+                # it just answered /query/info, don't stammer the poor thing
+                time.sleep(args.delay)
+                return cached
+        except Exception:
+            pass
+        print("{0} is no longer at {1}".format(venstar_name, cached))
+
+    print("INFO: Looking for {0} with SSDP".format(venstar_name))
+    start = time.time()
+    loop = asyncio.new_event_loop()
+    try:
+        venstar_url = loop.run_until_complete(
+            ssdp_discover(venstar_name, args.ssdp_timeout, args.ssdp_addr,
+                          args.ssdp_port))
+    finally:
+        loop.close()
+    print("SSDP returned url after {1:.1f} seconds: {0}".format(venstar_url, time.time() - start))
+
+    if venstar_url:
+        with url_cache_lock:
+            cache = load_url_cache(args.url_cache)
+            cache[venstar_name] = venstar_url
+            save_state(args.url_cache, cache)
+    return venstar_url
+
+
+class TsColumn(object):
+    """ Read-only view of the ts column of a runtimes list, so bisect can
+        search it without building a separate list.
+    """
+    def __init__(self, runtimes, end):
+        self.runtimes = runtimes
+        self.end = end
+
+    def __len__(self):
+        return self.end
+
+    def __getitem__(self, i):
+        return self.runtimes[i]['ts']
+
+
+def get_cutoff(max_days, since=None):
+    """ Oldest ts we don't want: max_days back, or the last ts already sent
+        if that is newer.
+    """
+    cutoff = int(time.time()) - max_days * 86400
+    if since is not None and since > cutoff:
+        cutoff = since
+    return cutoff
+
+
+def parse_json(json_data, max_days, since=None):
+    """ Build points from an in-memory runtimes list.  The last record (the
+        period still in progress) is dropped by index, and the max_days
+        cutoff is found with a binary search on ts, so only the records we
+        actually keep are ever turned into points.
+    """
+    runtimes = json_data['runtimes']
+    end = len(runtimes) - 1
+    if end <= 0:
+        return []
+    cutoff = get_cutoff(max_days, since)
+
+    # venstar always sends these in order, so only the endpoints and the
+    # records either side of the cutoff are checked, not every pair
+    ts = TsColumn(runtimes, end)
+    if ts[0] <= ts[end - 1]:
+        start = bisect.bisect_right(ts, cutoff)
+        if ((start == 0 or ts[start - 1] <= cutoff) and
+                (start == end or ts[start] > cutoff)):
+            return [make_point(runtimes[i]) for i in range(start, end)]
+
+    # just in case they weren't
+    return [make_point(dp) for dp in itertools.islice(runtimes, end)
+            if dp['ts'] > cutoff]
+
+
+class RuntimeStream(object):
+    """ Incrementally pull records out of the runtimes array of a venstar
+        /query/runtimes response.  Reads chunk_size bytes at a time and
+        yields each record as soon as it is complete, so only one chunk and
+        one record are ever held in memory.  count is the number of records
+        seen so far.
+    """
+    def __init__(self, stream, encoding='utf-8', chunk_size=65536):
+        self.stream = stream
+        self.encoding = encoding
+        self.chunk_size = chunk_size
+        self.count = 0
+
+    def __iter__(self):
+        decoder = json.JSONDecoder()
+        text = codecs.getincrementaldecoder(self.encoding)(errors='replace')
+        buf = ''
+        in_array = False
+        eof = False
+
+        while not eof:
+            chunk = self.stream.read(self.chunk_size)
+            if not chunk:
+                eof = True
+                buf += text.decode(b'', final=True)
+            else:
+                buf += text.decode(chunk)
+
+            if not in_array:
+                idx = buf.find('"runtimes"')
+                start = buf.find('[', idx) if idx >= 0 else -1
+                if start < 0:
+                    # keep enough to match a key split across chunks
+                    if idx < 0:
+                        buf = buf[-len('"runtimes"'):]
+                    continue
+                buf = buf[start + 1:]
+                in_array = True
+
+            pos = 0
+            while True:
+                while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                    pos += 1
+                if pos >= len(buf):
+                    break
+                if buf[pos] == ']':
+                    return
+                try:
+                    dp, pos = decoder.raw_decode(buf, pos)
+                except ValueError:
+                    # record is split across chunks, go read more
+                    break
+                self.count += 1
+                yield dp
+            buf = buf[pos:]
+
+
+def make_point(dp):
+    fields = {i: dp[i] for i in dp if i != 'ts'}
+    return {
+        "measurement": "venstar_runtime",
+        "time": dp['ts'],
+        "fields": fields
+    }
+
+
+def stream_points(records, max_days, since=None):
+    """ Turn a stream of runtime records into points, skipping the last
+        record (the period still in progress) and anything older than
+        max_days, or not newer than since.  Holds back one record so it
+        knows which is last.
+    """
+    cutoff = get_cutoff(max_days, since)
+    prev = None
+    for dp in records:
+        if prev is not None and prev['ts'] > cutoff:
+            yield make_point(prev)
+        prev = dp
+
+
+class WriteJob(object):
+    """ Tracks what made it into influx for one venstar """
+    def __init__(self, tags):
+        self.tags = tags
+        self.written = 0
+        self.last = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class InfluxWriter(object):
+    """ Does every influx write from one thread, over one connection.
+        Fetchers hand it chunks of points through a short queue, so they
+        keep downloading and parsing while influx is busy, but never get
+        more than a few chunks ahead.
+    """
+    def __init__(self, db_client, dry_run=False, depth=2):
+        self.db_client = db_client
+        self.dry_run = dry_run
+        self.chunks = queue.Queue(maxsize=depth)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.chunks.get()
+            if item is None:
+                return
+            job, chunk = item
+            if chunk is None:
+                job.done.set()
+                continue
+            if job.error is not None:
+                continue
+            if self.dry_run:
+                print(json.dumps(chunk, indent=2))
+                job.written += len(chunk)
+                continue
+            try:
+                self.db_client.write_points(chunk, tags=job.tags,
+                                            time_precision='s')
+                job.written += len(chunk)
+                last = max(point['time'] for point in chunk)
+                if job.last is None or last > job.last:
+                    job.last = last
+            except Exception as e:
+                job.error = e
+
+    def close(self):
+        self.chunks.put(None)
+        self.thread.join()
+
+
+def write_chunked(writer, job, points, chunk_size):
+    """ Feed points to the writer chunk_size at a time, and wait for all of
+        them to be written.  Chunks that made it before an error still count
+        in job.written and job.last.
+    """
+    try:
+        chunk = []
+        for point in points:
+            chunk.append(point)
+            if len(chunk) >= chunk_size:
+                writer.chunks.put((job, chunk))
+                chunk = []
+        if chunk:
+            writer.chunks.put((job, chunk))
+    finally:
+        writer.chunks.put((job, None))
+        job.done.wait()
+    return job
+
+
+def load_state(state_file):
+    """ The state file is a json dict of venstar name -> last ts sent """
+    try:
+        with open(state_file) as sf:
+            return json.load(sf)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(state_file, state):
+    tmp = state_file + '.tmp'
+    try:
+        with open(tmp, 'w') as sf:
+            json.dump(state, sf)
+        os.replace(tmp, state_file)
+    except OSError as e:
+        print("Cannot write state file {0}: {1}".format(state_file, str(e)))
+
+
+def query_last_ts(db_client, venstar_name):
+    """ No state for this venstar, ask influx for the newest record it has """
+    query = 'SELECT * FROM "venstar_runtime" WHERE "name" = \'{0}\' ORDER BY time DESC LIMIT 1'.format(
+        venstar_name.replace("\\", "\\\\").replace("'", "\\'"))
+    try:
+        points = list(db_client.query(query, epoch='s').get_points())
+    except Exception as e:
+        print("Cannot ask influx for last record: {0}".format(str(e)))
+        return None
+    if not points:
+        return None
+    return points[0]['time']
+
+
+def get_since(args, db_client, state, venstar_name):
+    """ Work out the high water mark for incremental mode """
+    if not args.incremental:
+        return None
+    since = state.get(venstar_name)
+    if since is None:
+        since = query_last_ts(db_client, venstar_name)
+    if since is not None:
+        print("Sending records newer than {0}".format(str(since)))
+    return since
 
-    notify_url = ''
-    i = 0
 
-    while notify_url is '' and i < 5:
-        result = subprocess.run(notify_cmd, stdout=subprocess.PIPE, shell=True)
-        r_url = result.stdout.decode("utf-8")
-        notify_url = r_url.rstrip()
-        i += 1
+def update_state(args, state, venstar_name, last):
+    if args.incremental and not args.dry_run and last is not None:
+        state[venstar_name] = last
+        save_state(args.state_file, state)
 
-    print("Notify returned url after {1} tries: {0}".format(notify_url, i))
-    return(notify_url)
 
+def load_targets(targets_file):
+    """ Targets file is one venstar per line, name then optional URL.
+        Blank lines and # comments are ignored.
+    """
+    targets = []
+    with open(targets_file) as tf:
+        for line in tf:
+            words = line.split('#', 1)[0].split()
+            if not words:
+                continue
+            url = words[1] if len(words) > 1 else None
+            targets.append((words[0], url))
+    return targets
 
-def parse_json(json_data, max_days):
-    now_sec = int(time.time())
 
-    json_body = []
-    for dp in json_data['runtimes']:
-        # skip last element
-        if dp == json_data['runtimes'][-1]:
-            continue
-        fields = {i: dp[i] for i in dp if i != 'ts'}
-        point = {
-            "measurement": "venstar_runtime",
-            "time": dp['ts'],
-            "fields": fields
-        }
-        if dp['ts'] > (now_sec - max_days * 86400):
-            json_body.append(point)
-    return(json_body)
+def ask_name(venstar_url):
+    ven_info = venstar_url + '/query/info'
+    info_d = urllib.request.urlopen(ven_info, timeout=10)
+    data = info_d.read()
+    encoding = info_d.info().get_content_charset('utf-8')
+    info_json = json.loads(data.decode(encoding))
+    info_d.close()
+    return info_json['name']
+
+
+def fetch_venstar(venstar_name, venstar_url, args, db_client, state, writer):
+    """ Pull the runtime history from one venstar and stream it into the
+        shared writer.  Runs in a worker thread, so the politeness delay only
+        holds up this venstar.  Returns (name, records seen, job).
+    """
+    if venstar_url is None:
+        venstar_url = find_venstar(venstar_name, args)
+        if venstar_url == '':
+            raise RuntimeError("Cannot find {0} with SSDP".format(venstar_name))
+
+    if venstar_name is None:
+        print("Asking venstar for it's name")
+        try:
+            venstar_name = ask_name(venstar_url)
+        except Exception as e:
+            raise RuntimeError("Cannot contact venstar for info: {0}".format(str(e)))
+        print("name: {0}".format(venstar_name))
+        # don't stammer the poor thing
+        time.sleep(args.delay)
+
+    since = get_since(args, db_client, state, venstar_name)
+    ven_runtimes = venstar_url + '/query/runtimes'
+    print("Asking {0} for runtime data".format(venstar_name))
+    try:
+        run_d = urllib.request.urlopen(ven_runtimes, timeout=240)
+    except Exception as e:
+        raise RuntimeError("Cannot contact venstar for runtime: {0}".format(str(e)))
+
+    encoding = run_d.info().get_content_charset('utf-8')
+    records = RuntimeStream(run_d, encoding)
+    job = WriteJob({"name": venstar_name})
+    try:
+        write_chunked(writer, job, stream_points(records, args.max_days, since),
+                      args.chunk_size)
+    except Exception as e:
+        raise RuntimeError("Cannot read runtime from {0}: {1}".format(venstar_name, str(e)))
+    finally:
+        run_d.close()
+    print("Venstar {0} gave us {1} results".format(venstar_name, str(records.count)))
+    return venstar_name, records.count, job
 
 
 def main():
@@ -102,6 +577,10 @@ def main():
         print("Cannot find db named {0}, please create".format(args.influx_db))
         exit(1)
 
+    state = {}
+    if args.incremental:
+        state = load_state(args.state_file)
+
     if args.file is not None:
         if args.venstar_name is None:
             venstar_name = 'MainSouth'
@@ -109,66 +588,59 @@ def main():
             venstar_name = args.venstar_name
         json_file = open(args.file)
         json_data = json.load(json_file)
-        json_body = parse_json(json_data, args.max_days)
-        tags = {"name": venstar_name}
+        since = get_since(args, db_client, state, venstar_name)
+        json_body = parse_json(json_data, args.max_days, since)
         if not args.dry_run:
-            db_client.write_points(json_body, tags=tags, time_precision='s')
+            writer = InfluxWriter(db_client)
+            try:
+                job = write_chunked(writer, WriteJob({"name": venstar_name}),
+                                    json_body, args.chunk_size)
+            finally:
+                writer.close()
+            update_state(args, state, venstar_name, job.last)
+            if job.error is not None:
+                print("Cannot contact influx: {0}".format(str(job.error)))
 
         exit(0)
 
-    if args.venstar_url is None:
-        if args.venstar_name is None:
-            print("ERROR: Need either venstar URL or name")
-            exit(1)
-        print("INFO: Running nofity, takes 65 seconds")
-        venstar_url = run_notify(args.venstar_name)
-    else:
-        venstar_url = args.venstar_url
-
-    if args.venstar_name is None:
-        print("Asking venstar for it's name")
-        ven_info = venstar_url + '/query/info'
+    if args.targets is not None:
         try:
-            info_d = urllib.request.urlopen(ven_info, timeout=10)
-        except Exception as e:
-            print("Cannot contact venstar for info: {0}".format(str(e)))
+            targets = load_targets(args.targets)
+        except OSError as e:
+            print("ERROR: Cannot read targets file: {0}".format(str(e)))
             exit(1)
-        data = info_d.read()
-        encoding = info_d.info().get_content_charset('utf-8')
-        info_json = json.loads(data.decode(encoding))
-        info_d.close()
-        venstar_name = info_json['name']
-        print("name: {0}".format(venstar_name))
-        # don't stammer the poor thing
-        time.sleep(5)
-    else:
-        venstar_name = args.venstar_name
-
-    ven_runtimes = venstar_url + '/query/runtimes'
-    print("Asking {0} for runtime data".format(venstar_name))
-    try:
-        run_d = urllib.request.urlopen(ven_runtimes, timeout=240)
-        data = run_d.read()
-        encoding = run_d.info().get_content_charset('utf-8')
-        runtime_data = json.loads(data.decode(encoding))
-        print("Venstar gave us {0} results".format(str(len(runtime_data['runtimes']))))
-        run_d.close()
-    except Exception as e:
-        print("Cannot contact venstar for runtime: {0}".format(str(e)))
+    elif args.venstar_url is None and args.venstar_name is None:
+        print("ERROR: Need either venstar URL or name")
         exit(1)
+    else:
+        targets = [(args.venstar_name, args.venstar_url)]
 
-    json_body = parse_json(runtime_data, args.max_days)
-    tags = {"name": venstar_name}
     if args.dry_run:
         print("Would send to influx:")
-        print(json.dumps(json_body, indent=2))
-        print("Tags:")
-        print(tags)
-    else:
-        try:
-            db_client.write_points(json_body, tags=tags, time_precision='s')
-        except Exception as e:
-            print("Cannot contact influx: {0}".format(str(e)))
-    exit(0)
+    writer = InfluxWriter(db_client, args.dry_run, depth=2 * args.workers)
+    failed = False
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as pool:
+            futures = [pool.submit(fetch_venstar, name, url, args, db_client,
+                                   state, writer) for name, url in targets]
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    venstar_name, count, job = future.result()
+                except RuntimeError as e:
+                    print(str(e))
+                    failed = True
+                    continue
+                update_state(args, state, venstar_name, job.last)
+                if args.dry_run:
+                    print("Tags:")
+                    print(job.tags)
+                elif job.error is not None:
+                    print("Cannot contact influx for {0}: {1}".format(venstar_name, str(job.error)))
+                else:
+                    print("Wrote {0} points for {1}".format(str(job.written), venstar_name))
+    finally:
+        # the pool has let go of the writer by now, however it got here
+        writer.close()
+    exit(1 if failed else 0)
 
 main()